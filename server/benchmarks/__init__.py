@@ -0,0 +1,36 @@
+"""
+Benchmarks of the server, run against a scratch PostgreSQL database:
+
+    BENCHMARK_DATABASE_URL=postgresql+asyncpg://admin:admin@db:5432/bench python -m benchmarks.<name>
+
+They drop and recreate every table of that database, so never point them at real data.
+"""
+
+import os
+import sys
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+BENCHMARK_DATABASE_URL = os.getenv("BENCHMARK_DATABASE_URL")
+
+# database.py and services/utils.py read these at import time; the benchmarks use their own engine
+os.environ.setdefault("DATABASE_URL", BENCHMARK_DATABASE_URL or "postgresql+asyncpg://localhost/benchmark")
+os.environ.setdefault("MEDIA_DIR", "benchmark_media")
+
+
+def create_benchmark_engine(**kwargs):
+    if not BENCHMARK_DATABASE_URL:
+        sys.exit("Set BENCHMARK_DATABASE_URL to a scratch database: the benchmark drops all of its tables")
+    engine = create_async_engine(BENCHMARK_DATABASE_URL, **kwargs)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Nearest-rank percentiles of a list of latencies, in milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {f"p{point}": None for point in points}
+    return {
+        f"p{point}": round(ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] * 1000, 3)
+        for point in points
+    }
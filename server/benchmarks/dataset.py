@@ -0,0 +1,259 @@
+"""
+Synthetic data set for the load benchmarks, generated inside PostgreSQL with generate_series.
+
+    python -m benchmarks.dataset --users 10000 --tweets 1000000 --seed 1
+
+The shape follows what a real service sees rather than uniform noise:
+
+* follows form a power-law graph: a few users are followed by a large share of everybody, most by
+  almost nobody, and how many users somebody follows is skewed the same way;
+* tweets are mostly written by the popular users;
+* likes pile up on the newest tweets, so the first feed pages carry the most likers;
+* a share of the tweets have one to four attachments (rows only, no files are written).
+
+Every skew is `random() ^ skew`: 1 is uniform, larger values concentrate on the low ids (users) or the
+newest ids (tweets). The same arguments and seed give the same data set, so baselines taken on different
+commits compare like with like. Counters and fan-out timelines are filled in as the app would keep them.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from sqlalchemy import text
+
+from benchmarks import create_benchmark_engine
+from benchmarks.search_latency import WORDS
+from database import Base
+from services.counters import repair_counters
+from services.service import TIMELINE_FANOUT_LIMIT
+
+# Tweets with attachments get ids ATTACHMENT_SLOTS * tweet_id + position, so no lookup is needed to link them
+ATTACHMENT_SLOTS = 4
+
+USERS_SQL = text(
+    """
+    INSERT INTO "user" (id, name, api_key, created_at, updated_at)
+    SELECT g, 'user' || g, 'user' || g, now(), now()
+    FROM generate_series(CAST(:first AS int), CAST(:last AS int)) AS g
+    """
+)
+
+FOLLOWS_SQL = text(
+    """
+    INSERT INTO follower (id, user_id, followed_user_id, created_at, updated_at)
+    SELECT nextval('follower_id_seq'), u, f.followed_user_id, now(), now()
+    FROM generate_series(CAST(:first AS int), CAST(:last AS int)) AS u
+    CROSS JOIN LATERAL (
+        SELECT 1 + floor(CAST(:users AS int) * random() ^ CAST(:skew AS float))::int AS followed_user_id
+        -- u in the bound makes the out-degree a fresh random draw for every user
+        FROM generate_series(1, 1 + floor(CAST(:max_follows AS int) * random() ^ CAST(:skew AS float) + 0 * u)::int)
+    ) AS f
+    WHERE f.followed_user_id <> u
+    ON CONFLICT DO NOTHING
+    """
+)
+
+# has_attachments and attachment_count must agree between the two statements, hence no random() in them
+HAS_ATTACHMENTS = "(g::bigint * 2654435761 % 1000) < CAST(:attachment_share AS float) * 1000"
+ATTACHMENT_COUNT = f"1 + (g * 7 % {ATTACHMENT_SLOTS})"
+
+ATTACHMENTS_SQL = text(
+    f"""
+    INSERT INTO attachment (id, path, created_at, updated_at)
+    SELECT {ATTACHMENT_SLOTS} * g + position, 'bench/' || g || '_' || position || '.jpg', now(), now()
+    FROM generate_series(CAST(:first AS int), CAST(:last AS int)) AS g
+    CROSS JOIN LATERAL generate_series(0, {ATTACHMENT_COUNT} - 1) AS position
+    WHERE {HAS_ATTACHMENTS}
+    """
+)
+
+TWEETS_SQL = text(
+    f"""
+    INSERT INTO tweet (id, content, user_id, attachments, like_count, created_at, updated_at)
+    SELECT g,
+           array_to_string(ARRAY(
+               SELECT (CAST(:words AS text[]))[1 + floor(cardinality(CAST(:words AS text[])) * random() ^ 3)::int]
+               FROM generate_series(1, 4 + g % 20)
+           ), ' '),
+           1 + floor(CAST(:users AS int) * random() ^ CAST(:skew AS float))::int,
+           CASE WHEN {HAS_ATTACHMENTS} THEN ARRAY(
+               SELECT {ATTACHMENT_SLOTS} * g + position FROM generate_series(0, {ATTACHMENT_COUNT} - 1) AS position
+           ) END,
+           0,
+           -- one tweet every "spacing" seconds, the newest one now
+           now() - make_interval(secs => (CAST(:tweets AS int) - g) * CAST(:spacing AS float)),
+           now()
+    FROM generate_series(CAST(:first AS int), CAST(:last AS int)) AS g
+    """
+)
+
+LIKES_SQL = text(
+    """
+    INSERT INTO "like" (id, user_id, tweet_id, created_at, updated_at)
+    SELECT nextval('like_id_seq'),
+           1 + floor(CAST(:users AS int) * random())::int,
+           CAST(:tweets AS int) - floor(CAST(:tweets AS int) * random() ^ CAST(:skew AS float))::int,
+           now(), now()
+    FROM generate_series(1, CAST(:count AS int))
+    ON CONFLICT DO NOTHING
+    """
+)
+
+TIMELINE_SQL = text(
+    """
+    INSERT INTO timeline (id, user_id, tweet_id, author_id, created_at, updated_at)
+    SELECT nextval('timeline_id_seq'), follower.user_id, tweet.id, tweet.user_id, tweet.created_at, now()
+    FROM tweet
+    JOIN "user" AS author ON author.id = tweet.user_id AND author.followers_count <= CAST(:fanout_limit AS int)
+    JOIN follower ON follower.followed_user_id = tweet.user_id
+    WHERE tweet.id BETWEEN :first AND :last
+    ON CONFLICT DO NOTHING
+    """
+)
+
+
+async def run_batches(session_factory, statement, total: int, batch_size: int, seed: float, **params):
+    """Run statement for id ranges [first, last] of batch_size, one transaction each"""
+    for first in range(1, total + 1, batch_size):
+        async with session_factory() as session:
+            async with session.begin():
+                await session.execute(text("SELECT setseed(:seed)"), {"seed": (seed + first / total) % 1})
+                await session.execute(
+                    statement, {"first": first, "last": min(first + batch_size - 1, total), **params}
+                )
+
+
+async def build_dataset(
+    session_factory,
+    users: int,
+    tweets: int,
+    max_follows: int,
+    likes_per_tweet: float,
+    attachment_share: float,
+    skew: float,
+    timeline_window: int,
+    batch_size: int,
+    seed: float,
+):
+    """Fill the (empty) benchmark database and return the parameters and row counts of the result"""
+    steps = [
+        ("users", USERS_SQL, users, {}),
+        ("follows", FOLLOWS_SQL, users, {"users": users, "max_follows": max_follows, "skew": skew}),
+        ("attachments", ATTACHMENTS_SQL, tweets, {"attachment_share": attachment_share}),
+        (
+            "tweets",
+            TWEETS_SQL,
+            tweets,
+            {
+                "users": users,
+                "tweets": tweets,
+                "skew": skew,
+                "words": WORDS,
+                "spacing": 60.0,
+                "attachment_share": attachment_share,
+            },
+        ),
+    ]
+    for name, statement, total, params in steps:
+        started = time.perf_counter()
+        await run_batches(session_factory, statement, total, batch_size, seed, **params)
+        print(f"{name}: {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    likes = int(tweets * likes_per_tweet)
+    for done in range(0, likes, batch_size):
+        async with session_factory() as session:
+            async with session.begin():
+                await session.execute(text("SELECT setseed(:seed)"), {"seed": (seed + done / likes) % 1})
+                await session.execute(
+                    LIKES_SQL, {"users": users, "tweets": tweets, "skew": skew, "count": min(batch_size, likes - done)}
+                )
+    print(f"likes: {time.perf_counter() - started:.1f}s")
+
+    async with session_factory() as session:
+        async with session.begin():
+            # Users, tweets and attachments were inserted with explicit ids
+            await session.execute(
+                text(
+                    "SELECT setval('user_id_seq', :users), setval('tweet_id_seq', :tweets), "
+                    "setval('attachment_id_seq', :attachments)"
+                ),
+                {"users": users, "tweets": tweets, "attachments": ATTACHMENT_SLOTS * (tweets + 1)},
+            )
+
+    started = time.perf_counter()
+    await repair_counters(session_factory, batch_size=batch_size)
+    print(f"counters: {time.perf_counter() - started:.1f}s")
+
+    # Timelines are materialized for the newest tweets only: older pages are never read by the load test
+    started = time.perf_counter()
+    first_tweet = max(tweets - timeline_window, 0)
+    for first in range(first_tweet + 1, tweets + 1, batch_size):
+        async with session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    TIMELINE_SQL,
+                    {
+                        "first": first,
+                        "last": min(first + batch_size - 1, tweets),
+                        "fanout_limit": TIMELINE_FANOUT_LIMIT,
+                    },
+                )
+    print(f"timelines: {time.perf_counter() - started:.1f}s")
+
+    async with session_factory() as session:
+        await session.execute(text("ANALYZE"))
+    return await describe_dataset(session_factory)
+
+
+async def describe_dataset(session_factory):
+    """Row counts and degree skew of the benchmark database, stored along with every baseline"""
+    async with session_factory() as session:
+        counts = {
+            table: await session.scalar(text(f'SELECT count(*) FROM "{table}"'))
+            for table in ("user", "follower", "tweet", "like", "attachment", "timeline")
+        }
+        counts["max_followers"] = await session.scalar(text('SELECT max(followers_count) FROM "user"'))
+        counts["median_followers"] = await session.scalar(
+            text('SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY followers_count) FROM "user"')
+        )
+        counts["max_likes"] = await session.scalar(text("SELECT max(like_count) FROM tweet"))
+    return counts
+
+
+async def main(args):
+    engine, session_factory = create_benchmark_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    description = await build_dataset(
+        session_factory,
+        users=args.users,
+        tweets=args.tweets,
+        max_follows=args.max_follows,
+        likes_per_tweet=args.likes_per_tweet,
+        attachment_share=args.attachment_share,
+        skew=args.skew,
+        timeline_window=args.timeline_window,
+        batch_size=args.batch_size,
+        seed=args.seed,
+    )
+    print(json.dumps(description))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--tweets", type=int, default=1_000_000)
+    parser.add_argument("--max-follows", type=int, default=1000, help="most users anybody follows")
+    parser.add_argument("--likes-per-tweet", type=float, default=5.0, help="mean, before duplicates are dropped")
+    parser.add_argument("--attachment-share", type=float, default=0.2, help="share of tweets with attachments")
+    parser.add_argument("--skew", type=float, default=3.0, help="exponent of the power-law draws, 1 is uniform")
+    parser.add_argument("--timeline-window", type=int, default=100_000, help="newest tweets fanned out")
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument("--seed", type=float, default=0.42, help="between 0 and 1, passed to setseed()")
+    asyncio.run(main(parser.parse_args()))
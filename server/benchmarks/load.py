@@ -0,0 +1,231 @@
+"""
+Throughput and latency of the API under concurrent load, per endpoint, on a data set built by
+benchmarks.dataset.
+
+    python -m benchmarks.load --concurrency 32 --duration 60 --save
+    python -m benchmarks.load --concurrency 32 --duration 60 --compare ../var/benchmarks/load-1a2b3c4.json
+
+Requests are sent with httpx, either to the ASGI app in this process (the default: no lifespan runs, so
+the data set is left as it is and jobs run inline) or with --url to a server started separately, e.g. uvicorn
+with several workers. Every worker coroutine draws an endpoint from --mix and sends the next request as soon
+as the previous one is answered, so --concurrency is the number of requests in flight. Requests that get no
+response (timeouts, refused or dropped connections) are counted as errors of their endpoint, by exception
+class, and left out of the latencies.
+
+--save writes the report as a JSON baseline named after the current commit; --compare runs again and prints
+the change of every endpoint against a saved baseline, failing when a p95 or the throughput got worse by
+more than --tolerance. Baselines only compare on the same machine, database and data set.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+from benchmarks import create_benchmark_engine, percentiles
+from benchmarks.dataset import describe_dataset
+from benchmarks.search_latency import WORDS
+
+BASELINES_DIR = Path(__file__).resolve().parent.parent.parent / "var" / "benchmarks"
+
+# endpoint name: (method, path template); {user} is a random user id, {tweet} a random recent tweet id
+ENDPOINTS = {
+    "feed": ("GET", "/api/tweets"),
+    "feed_thumbs": ("GET", "/api/tweets?media_size=thumb"),
+    "timeline": ("GET", "/api/timeline"),
+    "me": ("GET", "/api/users/me"),
+    "profile": ("GET", "/api/users/{user}"),
+    "search": ("GET", "/api/tweets/search?q={word}"),
+    "like": ("POST", "/api/tweets/{tweet}/likes"),
+}
+DEFAULT_MIX = "feed=35,feed_thumbs=5,timeline=25,me=10,profile=10,search=10,like=5"
+DATASET_TABLES = ("user", "follower", "tweet", "attachment")
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint {name!r}, choose from {', '.join(ENDPOINTS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Load:
+    def __init__(self, client: httpx.AsyncClient, mix: dict, users: int, tweets: int, skew: float):
+        self.client = client
+        self.names = list(mix)
+        self.weights = list(mix.values())
+        self.users = users
+        self.tweets = tweets
+        self.skew = skew
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.failures = defaultdict(Counter)
+
+    def request(self, rng: random.Random):
+        name = rng.choices(self.names, self.weights)[0]
+        method, template = ENDPOINTS[name]
+        # Readers are drawn uniformly, the profiles and tweets they look at with the data set's skew
+        reader = 1 + int(self.users * rng.random())
+        url = template.format(
+            user=1 + int(self.users * rng.random() ** self.skew),
+            tweet=self.tweets - int(self.tweets * rng.random() ** self.skew),
+            word=rng.choice(WORDS),
+        )
+        return name, method, url, {"Api-Key": f"user{reader}"}
+
+    async def worker(self, seed: int, deadline: float, record: bool):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            name, method, url, headers = self.request(rng)
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, headers=headers)
+            except httpx.HTTPError as exc:
+                if record:
+                    self.failures[name][type(exc).__name__] += 1
+                continue
+            elapsed = time.perf_counter() - started
+            if record:
+                self.samples[name].append(elapsed)
+                self.statuses[name][response.status_code] += 1
+
+    async def run(self, concurrency: int, duration: float, seed: int, record: bool = True):
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(self.worker(seed + i, deadline, record) for i in range(concurrency)))
+
+    def report(self, duration: float):
+        endpoints = {}
+        for name in self.names:
+            samples = self.samples[name]
+            statuses = self.statuses[name]
+            failures = self.failures[name]
+            endpoints[name] = {
+                "requests": len(samples),
+                "rps": round(len(samples) / duration, 2),
+                **percentiles(samples),
+                "errors": sum(count for status, count in statuses.items() if status >= 500) + sum(failures.values()),
+                "statuses": {str(status): count for status, count in sorted(statuses.items())},
+                "failures": dict(sorted(failures.items())),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {"rps": round(total / duration, 2), "endpoints": endpoints}
+
+
+def open_client(url: str, concurrency: int) -> httpx.AsyncClient:
+    if url:
+        return httpx.AsyncClient(
+            base_url=url,
+            timeout=30,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+
+    from main import app
+    from services import jobs
+
+    # The in-process app must neither log every request nor wait for a job worker
+    logging.getLogger("app_logger").setLevel(logging.WARNING)
+    logging.getLogger("app_logger.services").setLevel(logging.WARNING)
+    jobs.JOBS_EAGER = True
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=30)
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change of every endpoint against the baseline; return False when one regressed"""
+    ok = True
+    print(f"against {baseline['meta']['commit']} ({baseline['meta']['date']}):")
+    for name, current in report["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if not before or not before["requests"] or not current["requests"]:
+            continue
+        rps_change = current["rps"] / before["rps"] - 1
+        p95_change = current["p95"] / before["p95"] - 1
+        regressed = rps_change < -tolerance or p95_change > tolerance
+        ok = ok and not regressed
+        print(
+            f"  {name:12} rps {before['rps']:9.1f} -> {current['rps']:9.1f} ({rps_change:+.1%})"
+            f"  p95 {before['p95']:8.2f}ms -> {current['p95']:8.2f}ms ({p95_change:+.1%})"
+            + ("  REGRESSION" if regressed else "")
+        )
+    # Likes grow with every run that posts them, the rest of the data set must be the same
+    if any(baseline["meta"]["dataset"][table] != report["meta"]["dataset"][table] for table in DATASET_TABLES):
+        print("  warning: the baseline was taken on a different data set")
+    return ok
+
+
+async def main(args):
+    engine, session_factory = create_benchmark_engine()
+    dataset = await describe_dataset(session_factory)
+    await engine.dispose()
+    if not dataset["user"] or not dataset["tweet"]:
+        sys.exit("The benchmark database is empty, build a data set with python -m benchmarks.dataset first")
+
+    async with open_client(args.url, args.concurrency) as client:
+        load = Load(client, args.mix, users=dataset["user"], tweets=dataset["tweet"], skew=args.skew)
+        if args.warmup:
+            await load.run(args.concurrency, args.warmup, args.seed, record=False)
+        started = time.perf_counter()
+        await load.run(args.concurrency, args.duration, args.seed)
+        report = load.report(time.perf_counter() - started)
+
+    report["meta"] = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "target": args.url or "asgi",
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "mix": args.mix,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "dataset": dataset,
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        path = (
+            Path(args.save) if isinstance(args.save, str) else BASELINES_DIR / f"load-{report['meta']['commit']}.json"
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(report, indent=2))
+        print(f"saved {path}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running server instead of the in-process app")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"default {DEFAULT_MIX}")
+    parser.add_argument("--skew", type=float, default=3.0, help="as for benchmarks.dataset")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", nargs="?", const=True, help="save the report, by default under var/benchmarks")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p95 and throughput change")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+"""
+Throughput of the API under the benchmarks.load request mix for different engine settings: pool size
+and overflow, asyncpg statement caching, JIT and pre-ping.
+
+    python -m benchmarks.pool --concurrency 16 64 --duration 20
+    python -m benchmarks.pool --configs size=5,overflow=10 size=20,overflow=0,cache=0
+
+Every configuration gets a fresh engine created with database.create_engine, warmed up like in the lifespan
+and swapped in for the one of the in-process app. Besides throughput and latency the report shows how long
+requests waited for a pooled connection, which is what an undersized pool costs.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import database
+from benchmarks import BENCHMARK_DATABASE_URL, create_benchmark_engine, percentiles
+from benchmarks.dataset import describe_dataset
+from benchmarks.load import DEFAULT_MIX, Load, open_client, parse_mix
+
+# config key: database.create_engine argument
+SETTINGS = {
+    "size": ("pool_size", int),
+    "overflow": ("max_overflow", int),
+    "cache": ("statement_cache_size", int),
+    "jit": ("jit", str),
+    "pre_ping": ("pool_pre_ping", lambda value: value.lower() == "true"),
+    "recycle": ("pool_recycle", int),
+}
+DEFAULT_CONFIGS = [
+    "size=5,overflow=10",
+    "size=10,overflow=0",
+    "size=20,overflow=0",
+    "size=5,overflow=10,cache=0",
+    "size=5,overflow=10,jit=on",
+    "size=5,overflow=10,pre_ping=true",
+]
+
+
+def parse_config(config: str):
+    kwargs = {}
+    for part in config.split(","):
+        key, _, value = part.partition("=")
+        if key not in SETTINGS:
+            raise argparse.ArgumentTypeError(f"Unknown setting {key!r}, choose from {', '.join(SETTINGS)}")
+        name, convert = SETTINGS[key]
+        kwargs[name] = convert(value)
+    return kwargs
+
+
+async def measure(config: str, concurrency: int, client, mix, dataset, args):
+    engine = database.create_engine(BENCHMARK_DATABASE_URL, echo=False, **parse_config(config))
+    database.AsyncSession = async_sessionmaker(engine, expire_on_commit=False)
+    try:
+        await database.warm_up_pool(engine, engine.pool.size())
+        load = Load(client, mix, users=dataset["user"], tweets=dataset["tweet"], skew=args.skew)
+        if args.warmup:
+            await load.run(concurrency, args.warmup, args.seed, record=False)
+        engine.pool.checkouts = 0
+        engine.pool.wait_time = engine.pool.max_wait = 0.0
+        started = time.perf_counter()
+        await load.run(concurrency, args.duration, args.seed)
+        report = load.report(time.perf_counter() - started)
+        pool = database.pool_stats(engine)
+    finally:
+        await engine.dispose()
+
+    samples = [sample for endpoint in load.samples.values() for sample in endpoint]
+    return {
+        "config": config,
+        "concurrency": concurrency,
+        "rps": report["rps"],
+        **percentiles(samples),
+        "errors": sum(endpoint["errors"] for endpoint in report["endpoints"].values()),
+        "mean_checkout_wait_ms": round(pool["wait_time"] / max(pool["checkouts"], 1) * 1000, 3),
+        "max_checkout_wait_ms": round(pool["max_wait"] * 1000, 3),
+    }
+
+
+async def main(args):
+    engine, session_factory = create_benchmark_engine()
+    dataset = await describe_dataset(session_factory)
+    await engine.dispose()
+
+    app_session_factory = database.AsyncSession
+    report = []
+    async with open_client(None, max(args.concurrency)) as client:
+        try:
+            for concurrency in args.concurrency:
+                for config in args.configs:
+                    row = await measure(config, concurrency, client, args.mix, dataset, args)
+                    print(json.dumps(row))
+                    report.append(row)
+        finally:
+            database.AsyncSession = app_session_factory
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({"dataset": dataset, "results": report}, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs="+", type=str, default=DEFAULT_CONFIGS, help="setting=value,...")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--skew", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+    for config in args.configs:
+        parse_config(config)
+    asyncio.run(main(args))
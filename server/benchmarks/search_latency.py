@@ -0,0 +1,103 @@
+"""
+Latency of GET /api/tweets/search (TweetDAO.search) as the tweet table grows.
+
+    python -m benchmarks.search_latency --sizes 10000 100000 1000000 --runs 50
+
+For every size the tweet table is grown to that many rows of random Russian text and the query
+is timed for a rare term, a common term and the second page of the common term. The GIN index keeps
+the rare-term latency flat; the common-term latency grows with the number of matches that ts_rank
+has to score, which is the cost of ranking and not of finding the rows.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from sqlalchemy import text
+
+from benchmarks import create_benchmark_engine, percentiles
+from database import Base
+from models import User
+from services.service import TweetDAO
+
+# Skewed vocabulary: words near the start are drawn far more often (random() ** 3)
+WORDS = (
+    "день кошка город дом солнце работа друг утро вечер море книга дорога музыка окно зима лето "
+    "поезд река лес снег чай кофе письмо небо звезда праздник сад мост парк гора"
+).split()
+RARE_WORD = "гиппопотам"
+RARE_EVERY = 10000
+
+SEED_SQL = text(
+    """
+    INSERT INTO tweet (id, content, user_id, like_count, created_at, updated_at)
+    SELECT nextval('tweet_id_seq'),
+           array_to_string(ARRAY(
+               SELECT (CAST(:words AS text[]))[1 + floor(cardinality(CAST(:words AS text[])) * random() ^ 3)::int]
+               FROM generate_series(1, 12) WHERE g > 0
+           ), ' ') || CASE WHEN g % CAST(:rare_every AS int) = 0 THEN ' ' || CAST(:rare AS text) ELSE '' END,
+           1, 0, now(), now()
+    FROM generate_series(CAST(:first AS int), CAST(:last AS int)) AS g
+    """
+)
+
+
+async def grow_table(session_factory, current: int, size: int):
+    async with session_factory() as session:
+        async with session.begin():
+            await session.execute(
+                SEED_SQL,
+                {"words": WORDS, "rare": RARE_WORD, "rare_every": RARE_EVERY, "first": current + 1, "last": size},
+            )
+    async with session_factory() as session:
+        await session.execute(text("ANALYZE tweet"))
+
+
+async def measure(session_factory, q: str, runs: int, second_page: bool = False):
+    samples = []
+    async with session_factory() as session:
+        before = None
+        if second_page:
+            first_page = await TweetDAO.search(session, q=q, limit=20)
+            before = (first_page[-1].rank, first_page[-1].id) if first_page else None
+        for _ in range(runs):
+            started = time.perf_counter()
+            await TweetDAO.search(session, q=q, limit=20, before=before)
+            samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+async def main(sizes, runs):
+    engine, session_factory = create_benchmark_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_factory() as session:
+        async with session.begin():
+            session.add(User(name="bench", api_key="bench"))
+
+    report = []
+    current = 0
+    for size in sorted(sizes):
+        await grow_table(session_factory, current, size)
+        current = size
+        row = {
+            "rows": size,
+            "rare": await measure(session_factory, RARE_WORD, runs),
+            "common": await measure(session_factory, WORDS[0], runs),
+            "common_page_2": await measure(session_factory, WORDS[0], runs, second_page=True),
+        }
+        print(json.dumps(row, ensure_ascii=False))
+        report.append(row)
+
+    await engine.dispose()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--runs", type=int, default=30)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.runs))
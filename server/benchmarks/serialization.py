@@ -0,0 +1,87 @@
+"""
+CPU cost of serializing a feed page: the generic Pydantic + JSONResponse path against
+services.serializers, with every fragment rendered and with all of them cached. Needs no database.
+
+    python -m benchmarks.serialization --page-sizes 20 50 200 --likes 10 --runs 200
+
+Both paths start from the same row tuples, likers and attachment paths as returned by the DAOs,
+so only the work done after the queries is measured.
+"""
+
+import argparse
+import json
+import random
+import time
+from collections import namedtuple
+
+from fastapi.responses import JSONResponse
+
+from benchmarks import percentiles
+from schemas import TweetFull, TweetGetResponse
+from services.serializers import feed_page_to_bytes, tweet_fragment, tweet_to_dict
+
+FeedRow = namedtuple("FeedRow", "id content user_id name like_count created_at")
+
+
+def make_page(page_size: int, likes: int):
+    rows = [
+        FeedRow(tweet_id, "Твит номер %d: " % tweet_id + "слово " * random.randint(5, 40), 1, "Автор", likes, None)
+        for tweet_id in range(page_size, 0, -1)
+    ]
+    likes_by_tweet = {
+        row.id: [{"user_id": user_id, "name": f"user {user_id}"} for user_id in range(likes)] for row in rows
+    }
+    paths = {row.id: [f"/media/{row.id}.webp"] for row in rows if row.id % 3 == 0}
+    return rows, likes_by_tweet, paths
+
+
+def generic(rows, likes_by_tweet, paths):
+    tweets = [TweetFull(**tweet_to_dict(row, likes_by_tweet.get(row.id, []), paths.get(row.id, []))) for row in rows]
+    return JSONResponse(TweetGetResponse(result=True, tweets=tweets, next_cursor="cursor").model_dump()).body
+
+
+def render_fragments(rows, likes_by_tweet, paths):
+    return [tweet_fragment(row, likes_by_tweet.get(row.id, []), paths.get(row.id, [])) for row in rows]
+
+
+def fast(rows, likes_by_tweet, paths):
+    return feed_page_to_bytes(render_fragments(rows, likes_by_tweet, paths), "cursor")
+
+
+def cached(fragments):
+    return feed_page_to_bytes(fragments, "cursor")
+
+
+def measure(render, page, runs: int):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        render(*page)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def main(page_sizes, likes, runs):
+    report = []
+    for page_size in page_sizes:
+        page = make_page(page_size, likes)
+        assert generic(*page) == fast(*page), "the fast path must produce the same bytes"
+        row = {
+            "page_size": page_size,
+            "bytes": len(fast(*page)),
+            "generic": measure(generic, page, runs),
+            "orjson": measure(fast, page, runs),
+            "cached_fragments": measure(cached, (render_fragments(*page),), runs),
+        }
+        print(json.dumps(row))
+        report.append(row)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[20, 50, 200])
+    parser.add_argument("--likes", type=int, default=10, help="likes per tweet")
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+    main(args.page_sizes, args.likes, args.runs)
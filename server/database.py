@@ -1,21 +1,295 @@
+import asyncio
+import itertools
 import os
+import time
 from datetime import datetime
+from typing import Optional
 
+from fastapi import Request
 from fastapi.exceptions import HTTPException
-from sqlalchemy import DateTime, MetaData, func
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, declared_attr, mapped_column
+from sqlalchemy import DateTime, MetaData, Select, event, func, text
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncAttrs
+from sqlalchemy.ext.asyncio import AsyncSession as BaseAsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, declared_attr, mapped_column
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from logger_config import get_logger
+from services.cache import LRUCache
+from services.metrics import DB_POOL_CHECKOUT_WAIT, DB_POOL_CONNECTIONS
 
 logger = get_logger("app_logger")
 
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    The default pool of asyncpg engines, recording how long every checkout waits for a connection.
+    Metrics are labelled with engine_name, set by create_engine, so the primary and replica pools stay apart.
+    """
+
+    engine_name = "primary"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def recreate(self):
+        # engine.dispose() replaces the pool with a recreated one
+        pool = super().recreate()
+        pool.engine_name = self.engine_name
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            DB_POOL_CHECKOUT_WAIT.labels(self.engine_name).observe(wait)
+            self._record_usage()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._record_usage()
+
+    def _record_usage(self):
+        DB_POOL_CONNECTIONS.labels(self.engine_name, "checked_out").set(self.checkedout())
+        DB_POOL_CONNECTIONS.labels(self.engine_name, "overflow").set(max(self.overflow(), 0))
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "checkouts": self.checkouts,
+            "wait_time": round(self.wait_time, 6),
+            "max_wait": round(self.max_wait, 6),
+        }
+
+
 db_url = os.getenv("DATABASE_URL")
 # print(db_url)
 # db_url = "postgresql+asyncpg://admin:admin@db:5432/twitter"
-engine = create_async_engine(db_url, isolation_level="READ COMMITTED", echo=True)
 
-AsyncSession = async_sessionmaker(engine, expire_on_commit=False)
+# Echoing every statement is for debugging only; it costs a log record per query
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "false").lower() == "true"
+# Connections kept open per worker process, and how many more may be opened under a burst
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+# Seconds a request waits for a free connection before failing
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+# Connections older than this many seconds are replaced on checkout, -1 keeps them forever
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", -1))
+# Test every connection with a round trip on checkout; only needed when idle connections get cut
+DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_PRE_PING", "false").lower() == "true"
+# Connections opened by the lifespan before the first request
+DATABASE_POOL_WARMUP = int(os.getenv("DATABASE_POOL_WARMUP", DATABASE_POOL_SIZE))
+# Prepared statements cached per connection; set to 0 behind pgbouncer in transaction pooling mode
+DATABASE_STATEMENT_CACHE_SIZE = int(os.getenv("DATABASE_STATEMENT_CACHE_SIZE", 100))
+# JIT compilation costs more than it saves on the short queries of this app
+DATABASE_JIT = os.getenv("DATABASE_JIT", "off")
+DATABASE_APPLICATION_NAME = os.getenv("DATABASE_APPLICATION_NAME", "twitter_clone")
+
+
+def create_engine(
+    url: str = db_url,
+    pool_size: int = DATABASE_POOL_SIZE,
+    max_overflow: int = DATABASE_MAX_OVERFLOW,
+    pool_timeout: float = DATABASE_POOL_TIMEOUT,
+    pool_recycle: int = DATABASE_POOL_RECYCLE,
+    pool_pre_ping: bool = DATABASE_POOL_PRE_PING,
+    statement_cache_size: int = DATABASE_STATEMENT_CACHE_SIZE,
+    jit: str = DATABASE_JIT,
+    echo: bool = DATABASE_ECHO,
+    name: str = "primary",
+):
+    """The app's engine; the keyword arguments default to the DATABASE_* settings, name labels its pool metrics"""
+    engine = create_async_engine(
+        url,
+        isolation_level="READ COMMITTED",
+        echo=echo,
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        connect_args={
+            # The SQLAlchemy side cache of asyncpg prepared statements, and asyncpg's own
+            "prepared_statement_cache_size": statement_cache_size,
+            "statement_cache_size": statement_cache_size,
+            "server_settings": {"jit": jit, "application_name": DATABASE_APPLICATION_NAME},
+        },
+    )
+    engine.pool.engine_name = name
+    return engine
+
+
+engine = create_engine()
+
+# Comma-separated URLs of streaming replicas; without any, every query goes to the primary
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Replicas whose replay is further behind than this many seconds are taken out of rotation
+DATABASE_REPLICA_MAX_LAG = float(os.getenv("DATABASE_REPLICA_MAX_LAG", 2))
+DATABASE_REPLICA_CHECK_INTERVAL = float(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", 1))
+# Seconds after a write during which requests with the same Api-Key read from the primary
+DATABASE_READ_YOUR_WRITES_WINDOW = float(os.getenv("DATABASE_READ_YOUR_WRITES_WINDOW", 5))
+
+REPLICA_LAG_SQL = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+class ReplicaRouter:
+    """Round-robin over the replica engines whose replication lag is below max_lag"""
+
+    def __init__(self, replicas: list, max_lag: float = DATABASE_REPLICA_MAX_LAG):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.lag = {replica: 0.0 for replica in replicas}
+        self.autocommit = {
+            replica: replica.sync_engine.execution_options(isolation_level="AUTOCOMMIT") for replica in replicas
+        }
+        self.healthy = list(replicas)
+        self._turn = itertools.count()
+        self._checker: Optional[asyncio.Task] = None
+
+    def pick(self, autocommit: bool = False):
+        """The sync engine of the next healthy replica, or None to read from the primary"""
+        if not self.healthy:
+            return None
+        replica = self.healthy[next(self._turn) % len(self.healthy)]
+        return self.autocommit[replica] if autocommit else replica.sync_engine
+
+    def update(self, replica, lag: float):
+        if (lag > self.max_lag) != (self.lag[replica] > self.max_lag):
+            logger.warning(
+                "Replica %s %s rotation, lag %.1fs",
+                replica.url.host,
+                "out of" if lag > self.max_lag else "back in",
+                lag,
+            )
+        self.lag[replica] = lag
+        self.healthy = [replica for replica in self.replicas if self.lag[replica] <= self.max_lag]
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with replica.connect() as conn:
+                    lag = await conn.scalar(REPLICA_LAG_SQL)
+                # A server that is not in recovery is no replica at all
+                lag = float("inf") if lag is None else float(lag)
+            except Exception as exc:
+                logger.error("Replica %s lag check failed with %s: %s", replica.url.host, type(exc), exc)
+                lag = float("inf")
+            self.update(replica, lag)
+
+    async def _check_forever(self, interval: float):
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+    async def start(self, interval: float = DATABASE_REPLICA_CHECK_INTERVAL):
+        if self.replicas:
+            await self.check()
+            self._checker = asyncio.create_task(self._check_forever(interval))
+
+    async def stop(self):
+        if self._checker is not None:
+            self._checker.cancel()
+            await asyncio.gather(self._checker, return_exceptions=True)
+            self._checker = None
+        for replica in self.replicas:
+            await replica.dispose()
+
+    def stats(self) -> list:
+        return [
+            {"host": replica.url.host, "lag": self.lag[replica], "healthy": replica in self.healthy}
+            for replica in self.replicas
+        ]
+
+
+replica_router = ReplicaRouter(
+    [create_engine(url, name=f"replica{number}") for number, url in enumerate(DATABASE_REPLICA_URLS, 1)]
+)
+# Api-Keys that wrote recently, kept for the read-your-writes window
+recent_writers = LRUCache("recent_writers", maxsize=100000, ttl=DATABASE_READ_YOUR_WRITES_WINDOW)
+
+
+class RoutingSession(Session):
+    """
+    Send plain SELECTs to a replica when the session allows it (session.info["replica_reads"], set for read
+    sessions only) or the statement opts in with .execution_options(replica_reads=True), and everything else
+    to the primary. replica_reads=False keeps a statement on the primary in any session, as locks must be.
+    The first write pins the rest of the session to the primary, so that a request reads its own writes.
+    Read-only sessions (session.info["read_only"]) refuse to write.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None:
+            replica_reads = clause.get_execution_options().get("replica_reads", self.info.get("replica_reads"))
+            if replica_reads and not self.info.get("wrote"):
+                replica = replica_router.pick(autocommit=self.info.get("read_only", False))
+                if replica is not None:
+                    return replica
+        elif self.info.get("read_only"):
+            raise InvalidRequestError(f"Read-only session cannot run {clause if clause is not None else 'a flush'}")
+        else:
+            self.info["wrote"] = True
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+AsyncSession = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=RoutingSession)
+
+
+class ReadOnlySession(BaseAsyncSession):
+    """
+    Session of the GET endpoints. Its connections are in autocommit mode, so no BEGIN/COMMIT is sent, and
+    every statement gives its connection back to the pool as soon as its rows are buffered: a request holds
+    a connection only while a query runs, not while the response is rendered. Loaded objects are detached
+    right away, so everything a handler reads must be loaded by the query itself (options, not lazy loads).
+    """
+
+    async def execute(self, *args, **kwargs):
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            await self.close()
+
+    async def scalar(self, *args, **kwargs):
+        try:
+            return await super().scalar(*args, **kwargs)
+        finally:
+            await self.close()
+
+    async def get(self, *args, **kwargs):
+        try:
+            return await super().get(*args, **kwargs)
+        finally:
+            await self.close()
+
+
+ReadSession = async_sessionmaker(
+    engine.execution_options(isolation_level="AUTOCOMMIT"),
+    class_=ReadOnlySession,
+    expire_on_commit=False,
+    sync_session_class=RoutingSession,
+    info={"read_only": True},
+)
 
 
 # https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html#preventing-implicit-io-when-using-asyncsession
@@ -55,12 +329,25 @@ class Base(AsyncAttrs, DeclarativeBase):
         return str(self)
 
 
-async def get_session():
+def reads_from_replicas(api_key: Optional[str]) -> bool:
+    # Only read sessions use replicas; write transactions, jobs and scripts read from the primary
+    return bool(replica_router.replicas) and recent_writers.get(api_key) is None
+
+
+async def get_session(request: Request):
+    api_key = request.headers.get("Api-Key")
+    # Everything a write transaction reads, checks before writes and locks included, comes from the primary
     async with AsyncSession() as session:
         async with session.begin():
             try:
                 yield session
                 await session.commit()
+                if session.info.get("wrote") and api_key:
+                    recent_writers.set(api_key, True)
+            except HTTPException:
+                # Deliberate client errors (404, 413, ...) keep their status code
+                await session.rollback()
+                raise
             except Exception as exc:
                 await session.rollback()
                 raise HTTPException(
@@ -69,3 +356,70 @@ async def get_session():
                 )
             finally:
                 await session.close()
+
+
+async def get_read_session(request: Request):
+    """Session for requests that only read: no transaction and no connection held between queries"""
+    async with ReadSession() as session:
+        session.info["replica_reads"] = reads_from_replicas(request.headers.get("Api-Key"))
+        try:
+            yield session
+        except HTTPException:
+            raise
+        except Exception as exc:
+            raise HTTPException(
+                status_code=500,
+                detail=dict(result=False, error_type=f"{exc.__class__.__name__}", error_message=f"{str(exc)}"),
+            )
+
+
+async def warm_up_pool(engine=engine, connections: int = DATABASE_POOL_WARMUP) -> int:
+    """Open up to `connections` pooled connections at once, so that the first requests do not pay for connecting"""
+    connections = min(connections, engine.pool.size())
+    opened = [engine.connect() for _ in range(connections)]
+    try:
+        await asyncio.gather(*(conn.start() for conn in opened))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in opened), return_exceptions=True)
+    return connections
+
+
+def pool_stats(engine=engine) -> dict:
+    return engine.pool.stats()
+
+
+def on_commit(session, callback):
+    """
+    Run callback() once the session's transaction commits; it is dropped if the transaction rolls back.
+    Registering the same callback several times within one transaction runs it once.
+    """
+    callbacks = session.info.setdefault("on_commit", [])
+    if callback not in callbacks:
+        callbacks.append(callback)
+
+
+def on_rollback(session, callback):
+    """Run callback() if the session's transaction rolls back; it is dropped once the transaction commits"""
+    callbacks = session.info.setdefault("on_rollback", [])
+    if callback not in callbacks:
+        callbacks.append(callback)
+
+
+def _run_callbacks(callbacks, event_name: str):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as exc:
+            logger.error("On-%s callback %r failed with %s: %s", event_name, callback, type(exc), exc)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_on_commit_callbacks(session):
+    session.info.pop("on_rollback", None)
+    _run_callbacks(session.info.pop("on_commit", []), "commit")
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_on_commit_callbacks(session):
+    session.info.pop("on_commit", None)
+    _run_callbacks(session.info.pop("on_rollback", []), "rollback")
@@ -1,9 +1,28 @@
 import logging
+import logging.config
+import os
+import random
 import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import SimpleQueue
+
+import orjson
 
 LOGS_DIR = Path(__file__).parent.parent / "var" / "log" / "twitter_application"
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json | text, for the log files; the console always gets text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Share of DEBUG and INFO records that are kept, 1.0 keeps all; warnings and errors are never sampled out
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024))
+LOG_FILE_BACKUP_COUNT = int(os.getenv("LOG_FILE_BACKUP_COUNT", 5))
+
+# Attributes every LogRecord has; anything else was passed with `extra` and goes to the JSON output as is
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
 
 def get_logger(name):
     logger = logging.getLogger(name)
@@ -11,6 +30,69 @@ def get_logger(name):
     return logger
 
 
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the `extra` fields of the record at the top level"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Keep `rate` of the records up to `max_level` at random; records above it always pass"""
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE, max_level: int = logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        return record.levelno > self.max_level or self.rate >= 1 or random.random() < self.rate
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Put records on a queue that a background thread drains into `handlers`, so a logging call
+    never waits for a file write or a rotation.
+
+    Records are queued unformatted: the message is rendered on the listener thread, which means
+    only values that are not changed afterwards should be passed as logging arguments.
+    """
+
+    def __init__(self, handlers):
+        super().__init__(SimpleQueue())
+        # dictConfig hands over the cfg:// references as a converting list, indexing resolves them
+        self.listener = QueueListener(
+            self.queue, *[handlers[i] for i in range(len(handlers))], respect_handler_level=True
+        )
+        self.listener.start()
+
+    def prepare(self, record):
+        return record
+
+    def close(self):
+        # Called by logging.shutdown() and on reconfiguration: write out what is still queued
+        if self.listener._thread is not None:
+            self.listener.stop()
+        super().close()
+
+
+def configure_logging(config=None):
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    logging.config.dictConfig(config or dict_config)
+
+
 dict_config = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -19,6 +101,7 @@ dict_config = {
             "format": "%(asctime)s | %(name)s | %(levelname)s | %(lineno)s | %(message)s",
             "datefmt": "%Y-%m-%d %H:%M:%S",
         },
+        "jsonFormatter": {"()": JSONFormatter},
         "consoleFormatter": {
             "format": "%(asctime)s | %(name)s | %(levelname)s | %(message)s",
             "datefmt": "%Y-%m-%d %H:%M:%S",
@@ -33,6 +116,9 @@ dict_config = {
             "use_colors": None,
         },
     },
+    "filters": {
+        "sampling": {"()": SamplingFilter},
+    },
     "handlers": {
         "consoleHandler": {
             "class": "logging.StreamHandler",
@@ -44,19 +130,19 @@ dict_config = {
             "class": "logging.handlers.RotatingFileHandler",
             "level": "DEBUG",
             "mode": "a",
-            "formatter": "fileFormatter",
+            "formatter": "jsonFormatter" if LOG_FORMAT == "json" else "fileFormatter",
             "filename": LOGS_DIR / "app_debug.log",
-            "maxBytes": 1024,
-            # "backupCount": 1,
+            "maxBytes": LOG_FILE_MAX_BYTES,
+            "backupCount": LOG_FILE_BACKUP_COUNT,
         },
         "fileInfoHandler": {
             "class": "logging.handlers.RotatingFileHandler",
             "level": "INFO",
             "mode": "a",
-            "formatter": "fileFormatter",
+            "formatter": "jsonFormatter" if LOG_FORMAT == "json" else "fileFormatter",
             "filename": LOGS_DIR / "app_info.log",
-            "maxBytes": 1024,
-            # "backupCount": 1,
+            "maxBytes": LOG_FILE_MAX_BYTES,
+            "backupCount": LOG_FILE_BACKUP_COUNT,
         },
         "consoleAccessUvicornHandler": {
             "class": "logging.StreamHandler",
@@ -68,6 +154,33 @@ dict_config = {
             "formatter": "uvicornDefaultFormatter",
             "stream": "ext://sys.stderr",
         },
+        # The loggers only talk to these; the handlers above run on the queue listener threads
+        "queueAppHandler": {
+            "()": QueueListenerHandler,
+            "handlers": [
+                "cfg://handlers.consoleHandler",
+                "cfg://handlers.fileInfoHandler",
+                "cfg://handlers.fileDebugHandler",
+            ],
+            "filters": ["sampling"],
+        },
+        "queueUvicornHandler": {
+            "()": QueueListenerHandler,
+            "handlers": [
+                "cfg://handlers.consoleDefaultUvicornHandler",
+                "cfg://handlers.fileInfoHandler",
+                "cfg://handlers.fileDebugHandler",
+            ],
+        },
+        "queueUvicornAccessHandler": {
+            "()": QueueListenerHandler,
+            "handlers": [
+                "cfg://handlers.consoleAccessUvicornHandler",
+                "cfg://handlers.fileInfoHandler",
+                "cfg://handlers.fileDebugHandler",
+            ],
+            "filters": ["sampling"],
+        },
     },
     "loggers": {
         # "root": {
@@ -75,23 +188,23 @@ dict_config = {
         #     "handlers": ["consoleHandler"],
         # },
         "app_logger": {
-            "level": "DEBUG",
-            "handlers": ["consoleHandler", "fileInfoHandler", "fileDebugHandler"],
+            "level": LOG_LEVEL,
+            "handlers": ["queueAppHandler"],
             "propagate": False,
         },
         "app_logger.services": {
-            "level": "DEBUG",
-            "handlers": ["consoleHandler", "fileInfoHandler", "fileDebugHandler"],
+            "level": LOG_LEVEL,
+            "handlers": ["queueAppHandler"],
             "propagate": False,
         },
         "uvicorn": {
             "level": "INFO",
-            "handlers": ["consoleDefaultUvicornHandler", "fileInfoHandler", "fileDebugHandler"],
+            "handlers": ["queueUvicornHandler"],
             "propagate": False,
         },
         "uvicorn.access": {
             "level": "INFO",
-            "handlers": ["consoleAccessUvicornHandler", "fileInfoHandler", "fileDebugHandler"],
+            "handlers": ["queueUvicornAccessHandler"],
             "propagate": False,
         },
         "uvicorn.error": {"level": "INFO", "propagate": True},
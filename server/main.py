@@ -1,43 +1,56 @@
-import logging.config
 import os
 import time
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 from pathlib import Path
-from typing import Annotated, Optional, Union
+from typing import Annotated, List, Literal, Optional, Union
 
 import uvicorn
-from fastapi import (
-    Depends,
-    FastAPI,
-    HTTPException,
-    Request,
-    Security,
-    UploadFile,
-    status,
-)
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Security, UploadFile, status
+from fastapi.responses import JSONResponse, Response
 from fastapi.security.api_key import APIKeyHeader
-from sqlalchemy.exc import SQLAlchemyError
+from prometheus_client import CONTENT_TYPE_LATEST
 from sqlalchemy import delete
 
-from database import AsyncSession, engine, get_session
-from logger_config import dict_config, get_logger
-from models import Tweet, User
+from database import AsyncSession, engine, get_read_session, get_session, pool_stats, replica_router, warm_up_pool
+from logger_config import configure_logging, get_logger
+from models import User
 from schemas import (
     BaseResponse,
+    BatchResponse,
     ErrorResponse,
     MediaPostResponse,
-    TweetFull,
     TweetGetResponse,
     TweetPayloadIn,
     TweetPostResponse,
+    TweetSearchResponse,
+    TweetSearchResult,
     UserGetResponse,
+    UserPydantic,
 )
-from services.service import AttachmentDAO, FollowerDAO, LikeDAO, TweetDAO, UserDAO
-from services.utils import FileHandleService, get_user_response_data
-
-
-logging.config.dictConfig(dict_config)
+from services import jobs, tasks  # noqa: F401  registers the jobs
+from services.batch import BATCH_MAX_ITEMS, check_medias, follow_users, like_tweets, unfollow_users, unlike_tweets
+from services.cache import auth_cache, caches, feed_cache
+from services.etag import (
+    FEED_CACHE_CONTROL,
+    ME_CACHE_CONTROL,
+    USER_CACHE_CONTROL,
+    cache_headers,
+    etag_matches,
+    make_etag,
+    not_modified,
+)
+from services.feed import TweetRef, assemble_feed, render_feed
+from services.images import shutdown_executor
+from services.jobs import enqueue
+from services.media import store_upload
+from services.metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, UNMATCHED_ROUTE, mark_process_dead, render
+from services.pagination import decode_cursor, decode_rank_cursor, encode_rank_cursor, split_page
+from services.querystats import QUERY_STATS, QUERY_STATS_HEADER, track_queries, warn_repeated
+from services.serializers import JSONBytesResponse
+from services.service import FollowerDAO, LikeDAO, TimelineDAO, TweetDAO, UserDAO
+from services.utils import UploadSizeLimitMiddleware, get_user_response_data
+
+configure_logging()
 logger = get_logger("app_logger")
 
 api_key_header = APIKeyHeader(name="Api-Key", auto_error=False)
@@ -45,35 +58,54 @@ api_key_header = APIKeyHeader(name="Api-Key", auto_error=False)
 
 # Dependency to get current user based on API Key
 async def get_current_user(
-    api_key: Optional[str] = Security(api_key_header), session: AsyncSession = Depends(get_session)
-) -> User:
+    api_key: Optional[str] = Security(api_key_header), session: AsyncSession = Depends(get_read_session)
+) -> UserPydantic:
+    """
+    Resolve the Api-Key to the user's id and name only.
+    Endpoints that need the user's relationships load them themselves.
+    """
     if not api_key:
         logger.warning("Missing Api-Key in request headers.")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing API Key")
 
-    user = await UserDAO.find_one_or_none_lazy(
-        session=session,
-        filters={"api_key": api_key},
-        options=[User.following, User.followers, User.liked_tweets, User.tweets],
-    )
+    user = auth_cache.get(api_key)
+    if user is None:
+        generation = auth_cache.generation
+        user = await UserDAO.find_auth_user(session=session, api_key=api_key)
 
-    if not user:
-        logger.warning("Unauthorized access attempt with invalid Api-Key.")
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
+        if not user:
+            logger.warning("Unauthorized access attempt with invalid Api-Key.")
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
+
+        auth_cache.set(api_key, user, generation=generation)
 
     return user
 
 
-CurrentUserDep = Annotated[User, Depends(get_current_user)]
+CurrentUserDep = Annotated[UserPydantic, Depends(get_current_user)]
 SessionDep = Annotated[AsyncSession, Depends(get_session)]
+# GET endpoints: autocommit, and the connection goes back to the pool after every query, before rendering
+ReadSessionDep = Annotated[AsyncSession, Depends(get_read_session)]
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_DIR = BASE_DIR / os.getenv("MEDIA_DIR")
 
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", 50))
+FEED_MAX_PAGE_SIZE = 200
+
+LimitQuery = Annotated[int, Query(ge=1, le=FEED_MAX_PAGE_SIZE)]
+MediaSizeQuery = Annotated[
+    Optional[Literal["thumb", "small", "medium", "full"]],
+    Query(alias="media_size", description="Image variant to link instead of the original upload"),
+]
+CursorQuery = Annotated[Optional[str], Query(description="Opaque cursor taken from next_cursor of the previous page")]
+BatchIdsQuery = Annotated[List[int], Query(min_length=1, max_length=BATCH_MAX_ITEMS)]
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.warning("Start up")
+    logger.info("Opened %s database connections", await warm_up_pool())
 
     async with AsyncSession() as session:
         async with session.begin():
@@ -85,25 +117,56 @@ async def lifespan(app: FastAPI):
                     User(name="Christian", api_key="christian"),
                 ]
             )
+    await replica_router.start()
+    await jobs.start()
 
     yield
+    await jobs.stop()
+    await replica_router.stop()
     async with AsyncSession() as session:
         async with session.begin():
             await session.execute(delete(User))
+    shutdown_executor()
     await engine.dispose()
+    mark_process_dead()
 
 
 app = FastAPI(lifespan=lifespan, debug=False)
+app.add_middleware(UploadSizeLimitMiddleware, paths=("/api/medias",))
 
 
 @app.middleware("http")
 async def add_headers_middleware(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(round(process_time, 4))
+    in_flight = REQUESTS_IN_FLIGHT.labels(request.method)
+    in_flight.inc()
+    start_time = time.perf_counter()
+    status_code = 500
+    with track_queries() if QUERY_STATS else nullcontext() as query_stats:
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+        finally:
+            process_time = time.perf_counter() - start_time
+            in_flight.dec()
+            # The route template, not the path, so that /api/tweets/1 and /api/tweets/2 share a histogram
+            route = request.scope.get("route")
+            REQUEST_LATENCY.labels(request.method, route.path if route else UNMATCHED_ROUTE, status_code).observe(
+                process_time
+            )
+    response.headers["X-Process-Time"] = f"{process_time:.4f}"
+    extra = {"duration": process_time, "status_code": response.status_code}
+    if query_stats is not None:
+        warn_repeated(query_stats, f"{request.method} {request.url.path}")
+        extra.update(queries=query_stats.count, db_time=query_stats.duration)
+        if QUERY_STATS_HEADER:
+            response.headers["X-Query-Stats"] = query_stats.header()
     logger.info(
-        f"{request.method} {request.url.path} completed in {process_time:.4f}s with status {response.status_code}"
+        "%s %s completed in %.4fs with status %s",
+        request.method,
+        request.url.path,
+        process_time,
+        response.status_code,
+        extra=extra,
     )
     return response
 
@@ -116,27 +179,50 @@ async def add_headers_middleware(request: Request, call_next):
     },
     summary="Retrieve a user's information by user ID.",
 )
-async def get_auth_user(request: Request, cur_user: CurrentUserDep):
-    logger.info(f"Function <{get_auth_user.__name__}> gets Api-Key: {request.headers.get('Api-key')}")
+async def get_auth_user(request: Request, response: Response, cur_user: CurrentUserDep, session: ReadSessionDep):
+    logger.debug("Function <%s> called by user %s", get_auth_user.__name__, cur_user.id)
+
+    version = await UserDAO.find_version(session, user_id=cur_user.id)
+    if not version:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
+    etag = make_etag("user", cur_user.id, *version)
+    if etag_matches(request, etag):
+        return not_modified(etag, ME_CACHE_CONTROL, vary="Api-Key")
 
-    response = get_user_response_data(cur_user)
+    user = await UserDAO.find_one_or_none_lazy(
+        session=session,
+        filters={"id": cur_user.id},
+        options=[User.following, User.followers],
+    )
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
 
-    logger.info(f"Function <{get_auth_user.__name__}> return: {response}")
-    return UserGetResponse(**response)
+    response_data = get_user_response_data(user)
+    response.headers.update(cache_headers(etag, ME_CACHE_CONTROL, vary="Api-Key"))
+
+    logger.debug("Function <%s> return: %s", get_auth_user.__name__, response_data)
+    return UserGetResponse(**response_data)
 
 
 @app.get("/api/users/{user_id}", responses={200: {"model": UserGetResponse}, 500: {"model": ErrorResponse}})
-async def get_user(user_id: int, session: SessionDep):
+async def get_user(user_id: int, request: Request, response: Response, session: ReadSessionDep):
+    version = await UserDAO.find_version(session, user_id=user_id)
+    if not version:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    etag = make_etag("user", user_id, *version)
+    if etag_matches(request, etag):
+        return not_modified(etag, USER_CACHE_CONTROL)
+
     user = await UserDAO.find_one_or_none_lazy(
         session=session,
         filters={"id": user_id},
-        options=[User.following, User.followers, User.liked_tweets, User.tweets],
+        options=[User.following, User.followers],
     )
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    response = get_user_response_data(user)
-    return UserGetResponse(**response)
+    response.headers.update(cache_headers(etag, USER_CACHE_CONTROL))
+    return UserGetResponse(**get_user_response_data(user))
 
 
 @app.delete(
@@ -150,47 +236,119 @@ async def get_user(user_id: int, session: SessionDep):
     summary="Unfollow a user by user ID.",
 )
 async def follow(user_id: int, session: SessionDep, cur_user: CurrentUserDep, request: Request):
+    # Repeating a follow or an unfollow is a no-op with the same status, not a unique violation or a 500
     if request.method == "DELETE":
-        await FollowerDAO.delete(session=session, user_id=cur_user.id, followed_user_id=user_id)
+        await FollowerDAO.delete_if_exists(session=session, user_id=cur_user.id, followed_user_id=user_id)
         return JSONResponse({"result": True}, status_code=200)
 
-    await FollowerDAO.add(session=session, user_id=cur_user.id, followed_user_id=user_id)
+    await FollowerDAO.add_or_ignore(session=session, user_id=cur_user.id, followed_user_id=user_id)
     return JSONResponse({"result": True}, 201)
 
 
+@app.delete(
+    "/api/follows",
+    responses={200: {"model": BatchResponse}, 500: {"model": ErrorResponse}},
+    summary="Unfollow several users at once, with a status per user ID.",
+)
+@app.post(
+    "/api/follows",
+    responses={200: {"model": BatchResponse}, 500: {"model": ErrorResponse}},
+    summary="Follow several users at once, with a status per user ID.",
+)
+async def follow_many(user_ids: BatchIdsQuery, session: SessionDep, cur_user: CurrentUserDep, request: Request):
+    if request.method == "DELETE":
+        items = await unfollow_users(session, user_id=cur_user.id, user_ids=user_ids)
+    else:
+        items = await follow_users(session, user_id=cur_user.id, user_ids=user_ids)
+    return JSONResponse(BatchResponse(result=True, items=items).model_dump(), status_code=200)
+
+
 @app.get("/api/tweets", responses={200: {"model": TweetGetResponse}, 500: {"model": ErrorResponse}})
-async def get_all_tweets(session: SessionDep):
-    response = {"result": True}
+async def get_all_tweets(
+    request: Request,
+    session: ReadSessionDep,
+    limit: LimitQuery = FEED_PAGE_SIZE,
+    before: CursorQuery = None,
+    media_size: MediaSizeQuery = None,
+):
+    cache_key = (limit, before, media_size)
+    cached = feed_cache.get(cache_key)
+    if cached is not None:
+        etag, body = cached
+    else:
+        generation = feed_cache.generation
+        refs = await TweetDAO.find_feed_refs(session=session, limit=limit + 1, before=decode_cursor(before))
+        refs, next_cursor = split_page(refs, limit)
+        # The page changes exactly when one of its tweets, their versions or the next cursor do
+        etag = make_etag([(ref.id, ref.updated_at) for ref in refs], next_cursor, media_size)
+        body = None
+
+    if etag_matches(request, etag):
+        return not_modified(etag, FEED_CACHE_CONTROL)
+
+    if body is None:
+        body = await render_feed(session, refs, next_cursor, media_size=media_size)
+        feed_cache.set(cache_key, (etag, body), generation=generation)
+
+    return JSONBytesResponse(body, status_code=200, headers=cache_headers(etag, FEED_CACHE_CONTROL))
 
-    tweets = await TweetDAO.find_all_lazy(session=session, options=[Tweet.user, Tweet.liked_by])
-    for tweet in tweets:
-        response.setdefault("tweets", [])
-        tweet_dict = {
-            "id": tweet.id,
-            "content": tweet.content,
-            "author": {"id": tweet.user_id, "name": tweet.user.name},
-        }
-        likes = []
-        for user_like in tweet.liked_by:
-            user = await UserDAO.find_one_or_none_lazy(session=session, filters={"id": user_like.user_id}, options=[])
-            likes.append({"user_id": user_like.user_id, "name": user.name})
-        if len(likes) > 0:
-            tweet_dict["likes"] = likes
 
-        if tweet.attachments:
-            paths = await AttachmentDAO.find_attachments_path_by_tweet_id(session, tweet_ids=tweet.attachments)
-            tweet_dict["attachments"] = [path for path in paths[0]]
+@app.get(
+    "/api/tweets/search",
+    responses={200: {"model": TweetSearchResponse}, 500: {"model": ErrorResponse}},
+    summary="Full-text search of tweets, best matches first.",
+)
+async def search_tweets(
+    session: ReadSessionDep,
+    q: Annotated[str, Query(min_length=1, max_length=256, description="websearch_to_tsquery syntax")],
+    limit: LimitQuery = FEED_PAGE_SIZE,
+    before: CursorQuery = None,
+    media_size: MediaSizeQuery = None,
+):
+    matches = await TweetDAO.search(session, q=q, limit=limit + 1, before=decode_rank_cursor(before))
+    matches, next_cursor = split_page(matches, limit, encode=lambda row: encode_rank_cursor(row.rank, row.id))
+
+    tweet_rows = await TweetDAO.find_feed_rows_by_ids(session, tweet_ids=[match.id for match in matches])
+    tweets = {tweet.id: tweet for tweet in await assemble_feed(session, tweet_rows, media_size=media_size)}
+    results = [
+        TweetSearchResult(**tweets[match.id].model_dump(), highlight=match.highlight, rank=match.rank)
+        for match in matches
+        if match.id in tweets
+    ]
+
+    return JSONResponse(
+        TweetSearchResponse(result=True, tweets=results, next_cursor=next_cursor).model_dump(), status_code=200
+    )
 
-        response["tweets"].append(TweetFull(**tweet_dict))
 
-    return JSONResponse(TweetGetResponse(**response).model_dump(), status_code=200)
+@app.get(
+    "/api/timeline",
+    responses={200: {"model": TweetGetResponse}, 500: {"model": ErrorResponse}},
+    summary="Home timeline: tweets of the current user and of the users they follow.",
+)
+async def get_timeline(
+    session: ReadSessionDep,
+    cur_user: CurrentUserDep,
+    limit: LimitQuery = FEED_PAGE_SIZE,
+    before: CursorQuery = None,
+    media_size: MediaSizeQuery = None,
+):
+    refs = await TimelineDAO.find_tweet_refs(
+        session, user_id=cur_user.id, limit=limit + 1, before=decode_cursor(before)
+    )
+    refs, next_cursor = split_page(refs, limit)
+    versions = await TweetDAO.find_versions(session, tweet_ids=[ref.id for ref in refs])
+    refs = [TweetRef(ref.id, versions[ref.id]) for ref in refs if ref.id in versions]
+    response = await render_feed(session, refs, next_cursor, media_size=media_size)
+
+    return JSONBytesResponse(response, status_code=200)
 
 
 @app.post("/api/tweets", responses={201: {"model": TweetPostResponse}, 500: {"model": ErrorResponse}})
 async def add_tweet(
     payload: TweetPayloadIn, request: Request, session: SessionDep, cur_user: CurrentUserDep
 ) -> JSONResponse:
-    logger.info(f"Function <{get_auth_user.__name__}> gets Api-Key: {request.headers.get('Api-key')}")
+    logger.debug("Function <%s> called by user %s", add_tweet.__name__, cur_user.id)
 
     payload = payload.model_dump()
     if not payload["attachments"]:
@@ -210,31 +368,27 @@ async def create_media_file(session: SessionDep, file: Union[UploadFile, None] =
     Save a media file from user twit
     """
     if file:
-        logger.info(f"Function <{create_media_file.__name__}> gets {file}")
-        content = await file.read()
-        fileservice = FileHandleService(content=content, filename=file.filename)
-        unique_filename, out_file_path = await fileservice.save()
+        logger.debug("Function <%s> gets %s", create_media_file.__name__, file.filename)
+        new_attachment = await store_upload(session, file)
+        await enqueue(session, "media.process", attachment_id=new_attachment.id, path=new_attachment.path)
 
-        try:
-            new_attachment = await AttachmentDAO.add(session, path=str(out_file_path))
+        logger.debug("Function <%s> saved media %s", create_media_file.__name__, new_attachment.id)
+        return JSONResponse({"result": "true", "media_id": new_attachment.id}, 201)
 
-            logger.info(
-                f"Function <{create_media_file.__name__}> return:"
-                + str({"result": "true", "media_id": new_attachment.id})
-            )
-            return JSONResponse({"result": "true", "media_id": new_attachment.id}, 201)
 
-        except SQLAlchemyError:
-            await fileservice.delete(filepath=out_file_path)
-            logger.debug(f"The file {unique_filename} was deleted due to error on the db side")
-            raise
+@app.get(
+    "/api/medias",
+    responses={200: {"model": BatchResponse}, 500: {"model": ErrorResponse}},
+    summary="Check which media IDs exist, e.g. before posting a tweet with them.",
+)
+async def check_media_ids(ids: BatchIdsQuery, session: ReadSessionDep) -> JSONResponse:
+    items = await check_medias(session, media_ids=ids)
+    return JSONResponse(BatchResponse(result=True, items=items).model_dump(), status_code=200)
 
 
 @app.delete("/api/tweets/{tweet_id}", responses={200: {"model": BaseResponse}, 500: {"model": ErrorResponse}})
 async def del_tweet(tweet_id: int, session: SessionDep, cur_user: CurrentUserDep, request: Request):
-    logger.info(
-        f"Function <{del_tweet.__name__}> gets: api-Key: {request.headers.get('Api-key')}, tweet_id: {tweet_id}"
-    )
+    logger.debug("Function <%s> called by user %s, tweet_id: %s", del_tweet.__name__, cur_user.id, tweet_id)
 
     await TweetDAO.delete(session, id=tweet_id, user_id=cur_user.id)
 
@@ -244,14 +398,49 @@ async def del_tweet(tweet_id: int, session: SessionDep, cur_user: CurrentUserDep
 @app.delete("/api/tweets/{tweet_id}/likes", responses={200: {"model": BaseResponse}, 500: {"model": ErrorResponse}})
 @app.post("/api/tweets/{tweet_id}/likes", responses={201: {"model": BaseResponse}, 500: {"model": ErrorResponse}})
 async def like(tweet_id: int, session: SessionDep, cur_user: CurrentUserDep, request: Request) -> JSONResponse:
+    # Repeating a like or an unlike is a no-op with the same status, not a unique violation or a 500
     if request.method == "DELETE":
-        await LikeDAO.delete(session, tweet_id=tweet_id, user_id=cur_user.id)
+        await LikeDAO.delete_if_exists(session, tweet_id=tweet_id, user_id=cur_user.id)
         return JSONResponse({"result": True}, status_code=200)
 
-    await LikeDAO.add(session, tweet_id=tweet_id, user_id=cur_user.id)
+    await LikeDAO.add_or_ignore(session, tweet_id=tweet_id, user_id=cur_user.id)
 
     return JSONResponse({"result": True}, 201)
 
 
+@app.delete(
+    "/api/likes",
+    responses={200: {"model": BatchResponse}, 500: {"model": ErrorResponse}},
+    summary="Unlike several tweets at once, with a status per tweet ID.",
+)
+@app.post(
+    "/api/likes",
+    responses={200: {"model": BatchResponse}, 500: {"model": ErrorResponse}},
+    summary="Like several tweets at once, with a status per tweet ID.",
+)
+async def like_many(tweet_ids: BatchIdsQuery, session: SessionDep, cur_user: CurrentUserDep, request: Request):
+    if request.method == "DELETE":
+        items = await unlike_tweets(session, user_id=cur_user.id, tweet_ids=tweet_ids)
+    else:
+        items = await like_tweets(session, user_id=cur_user.id, tweet_ids=tweet_ids)
+    return JSONResponse(BatchResponse(result=True, items=items).model_dump(), status_code=200)
+
+
+@app.get("/api/cache/stats", summary="Hit, miss and eviction counters of the in-process caches of this worker.")
+async def get_cache_stats() -> JSONResponse:
+    return JSONResponse({"result": True, "caches": {name: cache.stats() for name, cache in caches.items()}})
+
+
+@app.get("/api/db/pool/stats", summary="Connection pool usage and checkout waits, replica lag of this worker.")
+async def get_pool_stats() -> JSONResponse:
+    return JSONResponse({"result": True, "pool": pool_stats(), "replicas": replica_router.stats()})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """Request, DAO, pool and media metrics in the Prometheus text format, of all workers"""
+    return Response(render(), media_type=CONTENT_TYPE_LATEST)
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
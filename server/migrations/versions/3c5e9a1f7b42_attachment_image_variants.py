@@ -0,0 +1,28 @@
+"""Attachment image variants
+
+Revision ID: 3c5e9a1f7b42
+Revises: 7bd01a06a687
+Create Date: 2026-10-17 14:02:11.418207
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "3c5e9a1f7b42"
+down_revision: Union[str, None] = "7bd01a06a687"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing attachments keep NULL and are served as originals
+    op.add_column("attachment", sa.Column("variants", postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("attachment", "variants")
@@ -0,0 +1,45 @@
+"""Denormalized like and follower counters
+
+Revision ID: 67fb13831225
+Revises: e0a5c72baccd
+Create Date: 2026-10-17 12:03:44.215809
+
+Existing rows start at 0; fill them with `python -m services.counters` after the upgrade.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "67fb13831225"
+down_revision: Union[str, None] = "e0a5c72baccd"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # A constant server default makes ADD COLUMN a metadata-only change, without rewriting the tables
+    op.add_column("tweet", sa.Column("like_count", sa.Integer(), server_default=sa.text("0"), nullable=False))
+    op.add_column("user", sa.Column("followers_count", sa.Integer(), server_default=sa.text("0"), nullable=False))
+    op.add_column("user", sa.Column("following_count", sa.Integer(), server_default=sa.text("0"), nullable=False))
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_like_tweet_id"),
+            "like",
+            ["tweet_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f("ix_like_tweet_id"), table_name="like", postgresql_concurrently=True)
+
+    op.drop_column("user", "following_count")
+    op.drop_column("user", "followers_count")
+    op.drop_column("tweet", "like_count")
@@ -0,0 +1,44 @@
+"""Content-addressed media blobs
+
+Revision ID: 7bd01a06a687
+Revises: 67fb13831225
+Create Date: 2026-10-17 13:26:52.660431
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7bd01a06a687"
+down_revision: Union[str, None] = "67fb13831225"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "blob",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("sha256", sa.VARCHAR(length=64), nullable=False),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("ref_count", sa.Integer(), server_default=sa.text("0"), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_blob")),
+        sa.UniqueConstraint("sha256", name=op.f("uq_blob_sha256")),
+    )
+    # Files uploaded before this revision keep blob_id NULL and are not deduplicated
+    op.add_column("attachment", sa.Column("blob_id", sa.Integer(), nullable=True))
+    op.create_foreign_key(op.f("fk_attachment_blob_id_blob"), "attachment", "blob", ["blob_id"], ["id"])
+    op.create_index(op.f("ix_attachment_blob_id"), "attachment", ["blob_id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_attachment_blob_id"), table_name="attachment")
+    op.drop_constraint(op.f("fk_attachment_blob_id_blob"), "attachment", type_="foreignkey")
+    op.drop_column("attachment", "blob_id")
+    op.drop_table("blob")
@@ -0,0 +1,36 @@
+"""Tweet attachments GIN index
+
+Revision ID: 9d4b2e7c6a13
+Revises: 3c5e9a1f7b42
+Create Date: 2026-10-17 14:48:05.771932
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9d4b2e7c6a13"
+down_revision: Union[str, None] = "3c5e9a1f7b42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently so the media garbage collector can be deployed without blocking tweet writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "gix_tweet_attachments",
+            "tweet",
+            ["attachments"],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("gix_tweet_attachments", table_name="tweet", postgresql_concurrently=True, if_exists=True)
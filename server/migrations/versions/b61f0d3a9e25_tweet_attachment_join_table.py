@@ -0,0 +1,114 @@
+"""Tweet attachment join table
+
+Revision ID: b61f0d3a9e25
+Revises: 9d4b2e7c6a13
+Create Date: 2026-10-17 15:21:40.093518
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b61f0d3a9e25"
+down_revision: Union[str, None] = "9d4b2e7c6a13"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def upgrade() -> None:
+    op.create_table(
+        "tweet_attachment",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.Column("attachment_id", sa.Integer(), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["attachment_id"],
+            ["attachment.id"],
+            name=op.f("fk_tweet_attachment_attachment_id_attachment"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweet.id"], name=op.f("fk_tweet_attachment_tweet_id_tweet"), ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_tweet_attachment")),
+        sa.UniqueConstraint("tweet_id", "position", name="uq_tweet_attachment_tweet_id_position"),
+    )
+
+    # From here on every write of tweet.attachments, by old and new application instances alike, is mirrored
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION tweet_attachment_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                DELETE FROM tweet_attachment WHERE tweet_id = NEW.id;
+            END IF;
+            INSERT INTO tweet_attachment (id, tweet_id, attachment_id, position, created_at, updated_at)
+            SELECT nextval('tweet_attachment_id_seq'), NEW.id, attachment.id, refs.position - 1, now(), now()
+            FROM unnest(NEW.attachments) WITH ORDINALITY AS refs (attachment_id, position)
+            JOIN attachment ON attachment.id = refs.attachment_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        "CREATE TRIGGER tweet_attachment_sync AFTER INSERT OR UPDATE OF attachments ON tweet "
+        "FOR EACH ROW EXECUTE FUNCTION tweet_attachment_sync()"
+    )
+
+    with op.get_context().autocommit_block():
+        # Existing tweets are copied in short id-range transactions; rows the trigger wrote meanwhile are kept
+        max_id = op.get_bind().execute(sa.text("SELECT coalesce(max(id), 0) FROM tweet")).scalar()
+        for first_id in range(1, max_id + 1, BACKFILL_BATCH_SIZE):
+            op.execute(
+                sa.text(
+                    """
+                    INSERT INTO tweet_attachment (tweet_id, attachment_id, position, created_at, updated_at)
+                    SELECT tweet.id, attachment.id, refs.position - 1, now(), now()
+                    FROM tweet
+                    CROSS JOIN unnest(tweet.attachments) WITH ORDINALITY AS refs (attachment_id, position)
+                    JOIN attachment ON attachment.id = refs.attachment_id
+                    WHERE tweet.id BETWEEN :first_id AND :last_id
+                    ON CONFLICT (tweet_id, position) DO NOTHING
+                    """
+                ).bindparams(first_id=first_id, last_id=first_id + BACKFILL_BATCH_SIZE - 1)
+            )
+
+        op.create_index(
+            op.f("ix_tweet_attachment_attachment_id"),
+            "tweet_attachment",
+            ["attachment_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Unreferenced media is now found with an anti-join on tweet_attachment
+        op.drop_index("gix_tweet_attachments", table_name="tweet", postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "gix_tweet_attachments",
+            "tweet",
+            ["attachments"],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.drop_index(
+            op.f("ix_tweet_attachment_attachment_id"), table_name="tweet_attachment", postgresql_concurrently=True
+        )
+
+    op.execute("DROP TRIGGER IF EXISTS tweet_attachment_sync ON tweet")
+    op.execute("DROP FUNCTION IF EXISTS tweet_attachment_sync()")
+    op.drop_table("tweet_attachment")
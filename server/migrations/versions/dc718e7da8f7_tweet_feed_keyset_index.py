@@ -0,0 +1,35 @@
+"""Tweet feed keyset index
+
+Revision ID: dc718e7da8f7
+Revises: d2074b098e84
+Create Date: 2026-10-17 09:12:31.402117
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "dc718e7da8f7"
+down_revision: Union[str, None] = "d2074b098e84"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY cannot run inside a transaction, but it does not block writes to a large tweet table
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweet_created_at_id",
+            "tweet",
+            ["created_at", "id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_tweet_created_at_id", table_name="tweet", postgresql_concurrently=True, if_exists=True)
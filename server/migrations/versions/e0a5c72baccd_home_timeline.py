@@ -0,0 +1,73 @@
+"""Home timeline
+
+Revision ID: e0a5c72baccd
+Revises: dc718e7da8f7
+Create Date: 2026-10-17 10:41:07.918230
+
+The table starts empty; once the upgrade to head is done (it needs the counters of 67fb13831225 and their
+backfill), fill it from the existing follows and tweets with `python -m services.timeline`.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e0a5c72baccd"
+down_revision: Union[str, None] = "dc718e7da8f7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "timeline",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["author_id"], ["user.id"], name=op.f("fk_timeline_author_id_user"), ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweet.id"], name=op.f("fk_timeline_tweet_id_tweet"), ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"], name=op.f("fk_timeline_user_id_user"), ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_timeline")),
+        sa.UniqueConstraint("user_id", "tweet_id", name=op.f("uq_timeline_user_id")),
+    )
+    op.create_index(
+        "ix_timeline_user_id_created_at_tweet_id", "timeline", ["user_id", "created_at", "tweet_id"], unique=False
+    )
+    op.create_index(op.f("ix_timeline_tweet_id"), "timeline", ["tweet_id"], unique=False)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_follower_followed_user_id"),
+            "follower",
+            ["followed_user_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_tweet_user_id_created_at_id",
+            "tweet",
+            ["user_id", "created_at", "id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_tweet_user_id_created_at_id", table_name="tweet", postgresql_concurrently=True)
+        op.drop_index(op.f("ix_follower_followed_user_id"), table_name="follower", postgresql_concurrently=True)
+
+    op.drop_index(op.f("ix_timeline_tweet_id"), table_name="timeline")
+    op.drop_index("ix_timeline_user_id_created_at_tweet_id", table_name="timeline")
+    op.drop_table("timeline")
@@ -1,7 +1,9 @@
-from typing import List
+from typing import List, Optional
 
 from sqlalchemy import (
+    DDL,
     VARCHAR,
+    BigInteger,
     CheckConstraint,
     ForeignKey,
     Index,
@@ -9,9 +11,10 @@ from sqlalchemy import (
     Sequence,
     String,
     UniqueConstraint,
+    event,
     text,
 )
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database import Base
@@ -25,7 +28,11 @@ class Like(Base):
     user: Mapped["User"] = relationship(back_populates="liked_tweets")
     tweet: Mapped["Tweet"] = relationship(back_populates="liked_by")
 
-    __table_args__ = (UniqueConstraint("user_id", "tweet_id", name=None),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "tweet_id", name=None),
+        # Likers of a page of tweets and like counts are looked up by tweet_id
+        Index(None, "tweet_id"),
+    )
 
 
 class Follower(Base):
@@ -40,6 +47,8 @@ class Follower(Base):
     __table_args__ = (
         UniqueConstraint("user_id", "followed_user_id", name=None),
         CheckConstraint("user_id != followed_user_id", name="check_user_not_follow_self"),
+        # Fan-out on write selects all followers of the tweet author
+        Index(None, "followed_user_id"),
     )
 
 
@@ -47,6 +56,9 @@ class User(Base):
     id: Mapped[int] = mapped_column(Sequence("user_id_seq"), primary_key=True)
     name: Mapped[str] = mapped_column(VARCHAR(50), nullable=False)
     api_key: Mapped[str] = mapped_column(VARCHAR(255), nullable=False, unique=True)
+    # Denormalized counters, maintained by FollowerDAO in the same transaction as the follower rows
+    followers_count: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    following_count: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
     # One-to-many relationship: one User to many Tweets
     tweets: Mapped[List["Tweet"]] = relationship(back_populates="user", cascade="all, delete")
     # Many-to-many relationship
@@ -84,17 +96,108 @@ class Tweet(Base):
     content: Mapped[str] = mapped_column(String, nullable=False)
     # One to many relationship means that parent(User) can have many child(Tweet)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
+    # Ids as posted by the client; the tweet_attachment rows kept in sync by a trigger are what is read
     attachments = mapped_column(ARRAY(Integer), nullable=True)
+    # Denormalized counter, maintained by LikeDAO in the same transaction as the like rows
+    like_count: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
     # Many-to-one relationship: each Tweet has one User
     user: Mapped["User"] = relationship(back_populates="tweets")
     # Many-to-many relationship
     liked_by: Mapped[List["Like"]] = relationship(back_populates="tweet", cascade="all, delete")
 
-    __table_args__ = (Index("gix_tweet_content_ru", text("to_tsvector('russian', content)"), postgresql_using="gin"),)
+    __table_args__ = (
+        Index("gix_tweet_content_ru", text("to_tsvector('russian', content)"), postgresql_using="gin"),
+        # Keyset pagination of the feed: ORDER BY created_at DESC, id DESC
+        Index("ix_tweet_created_at_id", "created_at", "id"),
+        # Fan-out on read pulls the latest tweets of the followed high-follower accounts
+        Index("ix_tweet_user_id_created_at_id", "user_id", "created_at", "id"),
+    )
+
+
+class Blob(Base):
+    """Content-addressed media file, stored once and shared by every attachment with the same bytes"""
+
+    id: Mapped[int] = mapped_column(Sequence("blob_id_seq"), primary_key=True)
+    sha256: Mapped[str] = mapped_column(VARCHAR(64), nullable=False, unique=True)
+    path: Mapped[str]
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # Number of attachments pointing at the blob; the file is removed when it drops to zero
+    ref_count: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
 
 
 class Attachment(Base):
     id: Mapped[int] = mapped_column(Sequence("attachment_id_seq"), primary_key=True)
     path: Mapped[str]
+    # NULL for files uploaded before the content-addressed store
+    blob_id: Mapped[Optional[int]] = mapped_column(ForeignKey("blob.id"), nullable=True)
+    # {variant name: path} of the resized, metadata-free copies; NULL until processed or for non-images
+    variants: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True)
 
-    __table_args__ = (Index(None, "id"),)
+    __table_args__ = (
+        Index(None, "id"),
+        Index(None, "blob_id"),
+    )
+
+
+class TweetAttachment(Base):
+    """Attachments of a tweet in the order they were posted, with referential integrity on both sides"""
+
+    __tablename__ = "tweet_attachment"
+
+    id: Mapped[int] = mapped_column(Sequence("tweet_attachment_id_seq"), primary_key=True)
+    tweet_id: Mapped[int] = mapped_column(ForeignKey("tweet.id", ondelete="CASCADE"))
+    attachment_id: Mapped[int] = mapped_column(ForeignKey("attachment.id", ondelete="CASCADE"))
+    # Index of the attachment in tweet.attachments
+    position: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Also serves the tweet side: attachments of a tweet in position order
+        UniqueConstraint("tweet_id", "position", name="uq_tweet_attachment_tweet_id_position"),
+        Index(None, "attachment_id"),
+    )
+
+
+# tweet_attachment is derived from tweet.attachments on every write of the array, so writers (including
+# application instances that predate the table) keep using the array. Ids without an attachment row are skipped.
+TWEET_ATTACHMENT_SYNC_FUNCTION = DDL(
+    """
+    CREATE OR REPLACE FUNCTION tweet_attachment_sync() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            DELETE FROM tweet_attachment WHERE tweet_id = NEW.id;
+        END IF;
+        INSERT INTO tweet_attachment (id, tweet_id, attachment_id, position, created_at, updated_at)
+        SELECT nextval('tweet_attachment_id_seq'), NEW.id, attachment.id, refs.position - 1, now(), now()
+        FROM unnest(NEW.attachments) WITH ORDINALITY AS refs (attachment_id, position)
+        JOIN attachment ON attachment.id = refs.attachment_id;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """
+)
+TWEET_ATTACHMENT_SYNC_TRIGGER = DDL(
+    "CREATE TRIGGER tweet_attachment_sync AFTER INSERT OR UPDATE OF attachments ON tweet "
+    "FOR EACH ROW EXECUTE FUNCTION tweet_attachment_sync()"
+)
+event.listen(TweetAttachment.__table__, "after_create", TWEET_ATTACHMENT_SYNC_FUNCTION)
+event.listen(TweetAttachment.__table__, "after_create", TWEET_ATTACHMENT_SYNC_TRIGGER)
+
+
+class Timeline(Base):
+    """
+    Materialized home timeline: one row per (follower, tweet), written when the tweet is posted.
+    created_at is copied from the tweet so that a user's rows are read in index order.
+    """
+
+    id: Mapped[int] = mapped_column(Sequence("timeline_id_seq"), primary_key=True)
+    # Owner of the timeline, i.e. the follower who reads it
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
+    tweet_id: Mapped[int] = mapped_column(ForeignKey("tweet.id", ondelete="CASCADE"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "tweet_id", name=None),
+        Index("ix_timeline_user_id_created_at_tweet_id", "user_id", "created_at", "tweet_id"),
+        # ON DELETE CASCADE from tweet looks rows up by tweet_id
+        Index(None, "tweet_id"),
+    )
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Optional, Union
+from typing import List, Literal, Optional, Union
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -87,6 +87,13 @@ class TweetFull(BaseModel):
     attachments: Union[List[str], List] = Field(default=[])
     author: BaseShort
     likes: Union[List[LikeShort], List] = Field(default=[])
+    like_count: int = Field(default=0)
+
+
+class TweetSearchResult(TweetFull):
+    # Matching fragments of the content, HTML-escaped, with the matched words in <b></b>
+    highlight: str
+    rank: float
 
 
 class UserFull(BaseModel):
@@ -94,6 +101,8 @@ class UserFull(BaseModel):
     name: str
     following: Union[List[LikeShort], List] = Field(default=[])
     followers: Union[List[LikeShort], List] = Field(default=[])
+    followers_count: int = Field(default=0)
+    following_count: int = Field(default=0)
 
 
 class BaseResponse(BaseModel):
@@ -107,6 +116,12 @@ class ErrorResponse(BaseResponse):
 
 class TweetGetResponse(BaseResponse):
     tweets: Union[List[TweetFull], List] = Field(default=[])
+    next_cursor: Optional[str] = Field(default=None)
+
+
+class TweetSearchResponse(BaseResponse):
+    tweets: Union[List[TweetSearchResult], List] = Field(default=[])
+    next_cursor: Optional[str] = Field(default=None)
 
 
 class TweetPostResponse(BaseResponse):
@@ -119,3 +134,12 @@ class UserGetResponse(BaseResponse):
 
 class MediaPostResponse(BaseResponse):
     media_id: int
+
+
+class BatchItemResult(BaseModel):
+    id: int
+    status: Literal["created", "exists", "deleted", "found", "not_found", "invalid"]
+
+
+class BatchResponse(BaseResponse):
+    items: List[BatchItemResult] = Field(default=[])
@@ -1,6 +1,7 @@
-from typing import Generic, TypeVar
+from typing import Generic, List, TypeVar
 
-from sqlalchemy import delete, insert, select
+from sqlalchemy import delete, insert, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
@@ -67,6 +68,20 @@ class BaseDAO(Generic[T]):
         except SQLAlchemyError as e:
             raise e
 
+    @classmethod
+    @logger_decorator
+    async def add_or_ignore(cls, session: AsyncSession, **kwargs):
+        """
+        INSERT ... ON CONFLICT DO NOTHING RETURNING: return the new record, or None when a row violating
+        a unique constraint already exists. No exception, so the transaction stays usable.
+        """
+        try:
+            query = pg_insert(cls.model).values(**kwargs).on_conflict_do_nothing().returning(cls.model)
+            result = await session.execute(query)
+            return result.scalar_one_or_none()
+        except SQLAlchemyError as e:
+            raise e
+
     @classmethod
     @logger_decorator
     async def delete(cls, session: AsyncSession, **kwargs):
@@ -82,3 +97,77 @@ class BaseDAO(Generic[T]):
             return record
         except SQLAlchemyError as e:
             raise e
+
+    @classmethod
+    @logger_decorator
+    async def delete_if_exists(cls, session: AsyncSession, **kwargs):
+        """Delete the row matching kwargs; return it, or None when there was none"""
+        try:
+            query = delete(cls.model).filter_by(**kwargs).returning(cls.model)
+            result = await session.execute(query)
+            return result.scalar_one_or_none()
+        except SQLAlchemyError as e:
+            raise e
+
+    @classmethod
+    def _keys_clause(cls, keys: List[dict]):
+        """(a, b) IN ((1, 2), (3, 4), ...) for a list of {column: value} dicts with the same columns"""
+        names = list(keys[0])
+        columns = [getattr(cls.model, name) for name in names]
+        if len(columns) == 1:
+            return columns[0].in_([key[names[0]] for key in keys])
+        return tuple_(*columns).in_([tuple(key[name] for name in names) for key in keys])
+
+    @classmethod
+    @logger_decorator
+    async def find_existing_ids(cls, session: AsyncSession, ids: List[int]) -> set:
+        """Return the subset of ids that have a row"""
+        if not ids:
+            return set()
+        result = await session.execute(select(cls.model.id).where(cls.model.id.in_(ids)))
+        return set(result.scalars().all())
+
+    @classmethod
+    @logger_decorator
+    async def add_many(cls, session: AsyncSession, rows: List[dict]):
+        """
+        Insert rows with multi-row INSERT ... RETURNING statements (batched by the driver's
+        insertmanyvalues limit) and return the records in the order of rows
+        """
+        if not rows:
+            return []
+        try:
+            query = insert(cls.model).returning(cls.model, sort_by_parameter_order=True)
+            result = await session.execute(query, rows)
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            raise e
+
+    @classmethod
+    @logger_decorator
+    async def add_many_or_ignore(cls, session: AsyncSession, rows: List[dict]):
+        """
+        As add_many, skipping the rows that conflict with existing ones: one multi-row
+        INSERT ... ON CONFLICT DO NOTHING RETURNING, which returns only the inserted records, in no particular order
+        """
+        if not rows:
+            return []
+        try:
+            query = pg_insert(cls.model).values(rows).on_conflict_do_nothing().returning(cls.model)
+            result = await session.execute(query)
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            raise e
+
+    @classmethod
+    @logger_decorator
+    async def delete_many(cls, session: AsyncSession, keys: List[dict]):
+        """Delete the rows matching any of keys with one DELETE ... WHERE (a, b) IN (...) and return them"""
+        if not keys:
+            return []
+        try:
+            query = delete(cls.model).where(cls._keys_clause(keys)).returning(cls.model)
+            result = await session.execute(query)
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            raise e
@@ -0,0 +1,73 @@
+"""
+Batch likes, follows and media checks: one request and a fixed number of statements for up to BATCH_MAX_ITEMS
+ids, with a status per id instead of one failure for the whole batch.
+
+Duplicated ids are reported once, in the order they were first given.
+"""
+
+import os
+from typing import List
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import BatchItemResult
+from services.service import AttachmentDAO, FollowerDAO, LikeDAO, TweetDAO, UserDAO
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+
+
+def _report(ids: List[int], statuses: dict, default: str) -> List[BatchItemResult]:
+    return [BatchItemResult(id=item_id, status=statuses.get(item_id, default)) for item_id in ids]
+
+
+async def like_tweets(session: AsyncSession, user_id: int, tweet_ids: List[int]) -> List[BatchItemResult]:
+    tweet_ids = list(dict.fromkeys(tweet_ids))
+    existing = await TweetDAO.find_existing_ids(session, tweet_ids)
+    # Likes that are already there are skipped by ON CONFLICT DO NOTHING: those tweets were liked before
+    statuses = dict.fromkeys(existing, "exists")
+    created = await LikeDAO.add_many_or_ignore(
+        session, [{"user_id": user_id, "tweet_id": tweet_id} for tweet_id in tweet_ids if tweet_id in existing]
+    )
+    statuses.update((like.tweet_id, "created") for like in created)
+    return _report(tweet_ids, statuses, "not_found")
+
+
+async def unlike_tweets(session: AsyncSession, user_id: int, tweet_ids: List[int]) -> List[BatchItemResult]:
+    tweet_ids = list(dict.fromkeys(tweet_ids))
+    deleted = await LikeDAO.delete_many(
+        session, [{"user_id": user_id, "tweet_id": tweet_id} for tweet_id in tweet_ids]
+    )
+    return _report(tweet_ids, {like.tweet_id: "deleted" for like in deleted}, "not_found")
+
+
+async def follow_users(session: AsyncSession, user_id: int, user_ids: List[int]) -> List[BatchItemResult]:
+    user_ids = list(dict.fromkeys(user_ids))
+    existing = await UserDAO.find_existing_ids(session, user_ids)
+    statuses = dict.fromkeys(existing, "exists")
+    # Following oneself violates check_user_not_follow_self
+    if user_id in existing:
+        statuses[user_id] = "invalid"
+    created = await FollowerDAO.add_many_or_ignore(
+        session,
+        [
+            {"user_id": user_id, "followed_user_id": followed_id}
+            for followed_id in user_ids
+            if statuses.get(followed_id) == "exists"
+        ],
+    )
+    statuses.update((follow.followed_user_id, "created") for follow in created)
+    return _report(user_ids, statuses, "not_found")
+
+
+async def unfollow_users(session: AsyncSession, user_id: int, user_ids: List[int]) -> List[BatchItemResult]:
+    user_ids = list(dict.fromkeys(user_ids))
+    deleted = await FollowerDAO.delete_many(
+        session, [{"user_id": user_id, "followed_user_id": followed_id} for followed_id in user_ids]
+    )
+    return _report(user_ids, {follow.followed_user_id: "deleted" for follow in deleted}, "not_found")
+
+
+async def check_medias(session: AsyncSession, media_ids: List[int]) -> List[BatchItemResult]:
+    media_ids = list(dict.fromkeys(media_ids))
+    existing = await AttachmentDAO.find_existing_ids(session, media_ids)
+    return _report(media_ids, dict.fromkeys(existing, "found"), "not_found")
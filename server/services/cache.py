@@ -0,0 +1,129 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# All caches by name, so their counters can be reported in one place
+caches: Dict[str, "LRUCache"] = {}
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with least-recently-used eviction and an optional time to live.
+
+    Each process keeps its own copy, so the TTL bounds how long another worker may serve an entry
+    that this one has already invalidated. With `maxweight`, entries are also evicted once the sum of
+    weigher(value) over all of them exceeds it, e.g. to cap the bytes held rather than the number of entries.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        maxweight: Optional[int] = None,
+        weigher: Callable[[Any], int] = lambda value: 1,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigher = weigher
+        self.weight = 0
+        self._data: "OrderedDict[Hashable, tuple[float, int, Any]]" = OrderedDict()
+        # Bumped on every clear(): a value computed before an invalidation must not be stored after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, weight, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.weight -= weight
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        """Store value; skipped when `generation` was read before the last clear()"""
+        if self.maxsize <= 0 or (generation is not None and generation != self.generation):
+            return
+        weight = self.weigher(value)
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+
+        self.delete(key)
+        expires_at = time.monotonic() + self.ttl if self.ttl else float("inf")
+        self._data[key] = (expires_at, weight, value)
+        self.weight += weight
+        while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+            _, (_, evicted_weight, _) = self._data.popitem(last=False)
+            self.weight -= evicted_weight
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.weight -= item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.weight = 0
+        self.generation += 1
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "maxweight": self.maxweight,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Assembled /api/tweets pages keyed by (limit, before, media_size)
+feed_cache = LRUCache(
+    "feed",
+    maxsize=int(os.getenv("FEED_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("FEED_CACHE_TTL", 5)),
+)
+
+# Api-Key -> UserPydantic(id, name) of the authenticated user
+auth_cache = LRUCache(
+    "auth",
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", 60)),
+)
+
+# tweet id -> (updated_at, {media_size: serialized TweetFull}); updated_at moves on every like, so a fragment
+# of an older version is never served. Capped by the bytes held.
+fragment_cache = LRUCache(
+    "fragments",
+    maxsize=int(os.getenv("FRAGMENT_CACHE_SIZE", 100_000)),
+    ttl=float(os.getenv("FRAGMENT_CACHE_TTL", 600)),
+    maxweight=int(os.getenv("FRAGMENT_CACHE_BYTES", 32 * 1024 * 1024)),
+    weigher=lambda entry: sum(len(fragment) for fragment in entry[1].values()),
+)
@@ -0,0 +1,84 @@
+"""
+Backfill and consistency check of the denormalized counters (tweet.like_count, user.followers_count,
+user.following_count).
+
+    python -m services.counters            # recompute and repair counters that drifted
+    python -m services.counters --check    # only report how many rows drifted
+"""
+
+import argparse
+import asyncio
+from typing import Callable, Dict
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSession as SessionFactory
+from logger_config import get_logger
+from models import Follower, Like, Tweet, User
+
+logger = get_logger("app_logger.services")
+
+BATCH_SIZE = 1000
+
+# counter column -> correlated subquery computing its true value from the join table
+COUNTERS: Dict[str, tuple] = {
+    "tweet.like_count": (Tweet.like_count, lambda: select(func.count(Like.id)).where(Like.tweet_id == Tweet.id)),
+    "user.followers_count": (
+        User.followers_count,
+        lambda: select(func.count(Follower.id)).where(Follower.followed_user_id == User.id),
+    ),
+    "user.following_count": (
+        User.following_count,
+        lambda: select(func.count(Follower.id)).where(Follower.user_id == User.id),
+    ),
+}
+
+
+async def repair_range(
+    session: AsyncSession, column, actual: Callable, first_id: int, last_id: int, dry_run: bool = False
+) -> int:
+    """Fix the counter for rows with first_id <= id <= last_id; return how many of them had drifted"""
+    model = column.class_
+    true_value = actual().scalar_subquery()
+    drifted = (model.id.between(first_id, last_id), column != true_value)
+
+    if dry_run:
+        return await session.scalar(select(func.count()).select_from(model).where(*drifted))
+
+    query = update(model).where(*drifted).values({column.key: true_value}).execution_options(synchronize_session=False)
+    result = await session.execute(query)
+    return result.rowcount
+
+
+async def repair_counters(session_factory=SessionFactory, batch_size: int = BATCH_SIZE, dry_run: bool = False):
+    """
+    Walk every counter table in id ranges of batch_size, one short transaction per range,
+    so the job never holds row locks on a large part of a table.
+    """
+    report = {}
+    for name, (column, actual) in COUNTERS.items():
+        async with session_factory() as session:
+            max_id = await session.scalar(select(func.max(column.class_.id))) or 0
+
+        drifted = 0
+        for first_id in range(1, max_id + 1, batch_size):
+            async with session_factory() as session:
+                async with session.begin():
+                    drifted += await repair_range(
+                        session, column, actual, first_id, first_id + batch_size - 1, dry_run
+                    )
+
+        report[name] = drifted
+        logger.info("Counter %s: %s drifted rows %s", name, drifted, "found" if dry_run else "repaired")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill and repair denormalized counters")
+    parser.add_argument("--check", action="store_true", help="only report drifted rows, do not repair them")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    print(asyncio.run(repair_counters(batch_size=args.batch_size, dry_run=args.check)))
@@ -0,0 +1,46 @@
+"""
+Conditional GET support.
+
+ETags are derived from version stamps the endpoint already has at hand (ids and updated_at of the
+tweets of a page, counters and updated_at of a user), never from the body, so a matching If-None-Match
+is answered with 304 before the response is assembled or serialized.
+"""
+
+import hashlib
+import os
+from typing import Optional
+
+from fastapi import Request, Response, status
+
+# The public feed and public profiles may be stored by nginx for a few seconds and revalidated after
+FEED_CACHE_CONTROL = os.getenv("FEED_CACHE_CONTROL", "public, max-age=5, must-revalidate")
+USER_CACHE_CONTROL = os.getenv("USER_CACHE_CONTROL", "public, max-age=5, must-revalidate")
+# /api/users/me depends on the Api-Key: browsers may keep it but must revalidate, shared caches must not store it
+ME_CACHE_CONTROL = os.getenv("ME_CACHE_CONTROL", "private, no-cache")
+
+
+def make_etag(*stamp) -> str:
+    """Strong ETag from a version stamp: any values with a stable repr()"""
+    return '"' + hashlib.blake2b(repr(stamp).encode(), digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match uses the weak comparison: W/ prefixes are ignored"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def cache_headers(etag: str, cache_control: str, vary: Optional[str] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = vary
+    return headers
+
+
+def not_modified(etag: str, cache_control: str, vary: Optional[str] = None) -> Response:
+    """A 304 carries the same caching headers, Vary included, as the 200 it stands for"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, cache_control, vary))
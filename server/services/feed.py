@@ -0,0 +1,76 @@
+from collections import defaultdict, namedtuple
+from typing import List, Optional, Sequence
+
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import TweetFull
+from services.cache import fragment_cache
+from services.serializers import feed_page_to_bytes, tweet_fragment, tweet_to_dict
+from services.service import AttachmentDAO, LikeDAO, TweetDAO
+
+# Tweet of a page and the version of its rendered fragment
+TweetRef = namedtuple("TweetRef", "id updated_at")
+
+
+async def load_feed_relations(session: AsyncSession, tweet_ids: List[int], media_size: Optional[str] = None):
+    """
+    Return ({tweet_id: [like, ...]}, {tweet_id: [path, ...]}) for the given tweets.
+
+    Likers and attachment paths are loaded with one set-based query each, whatever the number
+    of tweets or likes, and then matched to the tweets in memory. `media_size` picks an image variant
+    (thumb, small, medium, full) instead of the original file where one exists.
+    """
+    likes_by_tweet = defaultdict(list)
+    for tweet_id, user_id, name in await LikeDAO.find_likers_by_tweet_ids(session, tweet_ids=tweet_ids):
+        likes_by_tweet[tweet_id].append({"user_id": user_id, "name": name})
+
+    paths = await AttachmentDAO.find_paths_by_tweet_ids(session, tweet_ids=tweet_ids, size=media_size)
+    return likes_by_tweet, paths
+
+
+async def assemble_feed(
+    session: AsyncSession, tweet_rows: Sequence[Row], media_size: Optional[str] = None
+) -> List[TweetFull]:
+    """Build TweetFull objects for feed rows as returned by TweetDAO.find_feed_rows_by_ids"""
+    if not tweet_rows:
+        return []
+
+    likes_by_tweet, paths = await load_feed_relations(session, [row.id for row in tweet_rows], media_size)
+    return [
+        TweetFull(**tweet_to_dict(row, likes_by_tweet.get(row.id, []), paths.get(row.id, []))) for row in tweet_rows
+    ]
+
+
+async def render_feed(
+    session: AsyncSession, refs: Sequence[Row], next_cursor: Optional[str], media_size: Optional[str] = None
+) -> bytes:
+    """
+    Serialize a feed page to the JSON of schemas.TweetGetResponse from the (id, updated_at) refs of its tweets.
+
+    Tweets whose fragment for this version is cached are not read at all; the others are loaded and rendered
+    together, with the same batched queries as a cold page, and their fragments stored for the next request.
+    """
+    fragments, cached, missing = {}, {}, []
+    for ref in refs:
+        entry = fragment_cache.get(ref.id)
+        fragment = entry[1].get(media_size) if entry is not None and entry[0] == ref.updated_at else None
+        if fragment is None:
+            missing.append(ref.id)
+            cached[ref.id] = entry
+        else:
+            fragments[ref.id] = fragment
+
+    if missing:
+        tweet_rows = await TweetDAO.find_feed_rows_by_ids(session, tweet_ids=missing)
+        likes_by_tweet, paths = await load_feed_relations(session, missing, media_size)
+        for row in tweet_rows:
+            fragment = tweet_fragment(row, likes_by_tweet.get(row.id, []), paths.get(row.id, []))
+            fragments[row.id] = fragment
+            # Keep the fragments of other media sizes that belong to the same version
+            entry = cached[row.id]
+            by_size = dict(entry[1]) if entry is not None and entry[0] == row.updated_at else {}
+            by_size[media_size] = fragment
+            fragment_cache.set(row.id, (row.updated_at, by_size))
+
+    return feed_page_to_bytes([fragments[ref.id] for ref in refs if ref.id in fragments], next_cursor)
@@ -0,0 +1,155 @@
+"""
+Garbage collection of orphaned media: attachments of deleted tweets and uploads never attached to a tweet.
+
+    python -m services.gc              # delete orphans older than the grace period
+    python -m services.gc --dry-run    # only report what would be deleted
+
+Attachments are walked in id order, one short transaction per batch: the batch is marked with an anti-join
+on tweet_attachment (an ix_tweet_attachment_attachment_id lookup per attachment, the tweet table is not read)
+and the orphans are swept with the reference check repeated in the DELETE itself.
+Files are removed only after their batch has committed, and only if no blob has taken their path since.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+
+from sqlalchemy import func, select
+
+from database import AsyncSession as SessionFactory
+from logger_config import get_logger
+from models import Attachment, Blob
+from services import utils
+from services.media import remove_unreferenced_file
+from services.service import AttachmentDAO, BlobDAO
+
+logger = get_logger("app_logger.services")
+
+# Uploads younger than this may still be about to be attached to a tweet
+GC_GRACE_PERIOD = timedelta(seconds=int(os.getenv("MEDIA_GC_GRACE_PERIOD", 24 * 60 * 60)))
+GC_BATCH_SIZE = int(os.getenv("MEDIA_GC_BATCH_SIZE", 500))
+# Pause between batches, so the collector never competes with the app for long
+GC_BATCH_PAUSE = float(os.getenv("MEDIA_GC_BATCH_PAUSE", 0.2))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+async def collect_batch(session, after_id: int, batch_size: int, grace_period: timedelta, dry_run: bool = False):
+    """
+    Mark and sweep the next batch of attachments with id > after_id.
+    Return (last id looked at or None when there is nothing left, deleted count, reclaimed bytes, files to remove).
+    """
+    query = (
+        select(Attachment.id, Attachment.path, Attachment.blob_id, AttachmentDAO.unreferenced().label("orphan"))
+        .where(Attachment.id > after_id, Attachment.created_at < func.now() - grace_period)
+        .order_by(Attachment.id)
+        .limit(batch_size)
+    )
+    candidates = (await session.execute(query)).all()
+    if not candidates:
+        return None, 0, 0, []
+
+    orphans = [row for row in candidates if row.orphan]
+    if orphans and not dry_run:
+        orphans = await AttachmentDAO.delete_orphans(session, attachment_ids=[row.id for row in orphans])
+
+    reclaimed, files = 0, []
+    blob_refs = Counter(row.blob_id for row in orphans if row.blob_id is not None)
+    for row in orphans:
+        # Files uploaded before the content-addressed store belong to their attachment alone
+        if row.blob_id is None:
+            reclaimed += _file_size(row.path)
+            files.append(row.path)
+    if dry_run and blob_refs:
+        blobs = await session.execute(select(Blob.id, Blob.ref_count, Blob.size).where(Blob.id.in_(blob_refs)))
+        reclaimed += sum(blob.size for blob in blobs.all() if blob.ref_count <= blob_refs[blob.id])
+    elif not dry_run:
+        for blob_id, count in blob_refs.items():
+            released = await BlobDAO.release(session, blob_id, count=count)
+            if released:
+                reclaimed += released.size
+                files.append(released.path)
+
+    return candidates[-1].id, len(orphans), reclaimed, files
+
+
+def remove_stale_uploads(media_dir: Path, grace_period: timedelta, dry_run: bool = False):
+    """Remove partial uploads (*.part) left behind by crashed requests; return (count, bytes)"""
+    cutoff = time.time() - grace_period.total_seconds()
+    count = reclaimed = 0
+    for path in media_dir.glob("*.part"):
+        stat = path.stat()
+        if stat.st_mtime < cutoff:
+            count += 1
+            reclaimed += stat.st_size
+            if not dry_run:
+                path.unlink(missing_ok=True)
+    return count, reclaimed
+
+
+async def collect_orphans(
+    session_factory=SessionFactory,
+    batch_size: int = GC_BATCH_SIZE,
+    grace_period: timedelta = GC_GRACE_PERIOD,
+    pause: float = GC_BATCH_PAUSE,
+    dry_run: bool = False,
+):
+    """Run a full incremental pass and return how many attachments, partial uploads and bytes were reclaimed"""
+    report = {"attachments": 0, "partial_uploads": 0, "bytes": 0}
+    after_id = 0
+    while True:
+        async with session_factory() as session:
+            async with session.begin():
+                after_id, deleted, reclaimed, files = await collect_batch(
+                    session, after_id, batch_size, grace_period, dry_run
+                )
+        if after_id is None:
+            break
+
+        if files and not dry_run:
+            # Checked again right before unlinking: the same bytes may have been uploaded since the batch
+            async with session_factory() as session:
+                async with session.begin():
+                    for path in files:
+                        await remove_unreferenced_file(session, path)
+        report["attachments"] += deleted
+        report["bytes"] += reclaimed
+        if deleted:
+            logger.info("Media GC batch up to attachment %s: %s orphans, %s bytes", after_id, deleted, reclaimed)
+        await asyncio.sleep(pause)
+
+    count, reclaimed = remove_stale_uploads(utils.MEDIA_DIR, grace_period, dry_run)
+    report["partial_uploads"] = count
+    report["bytes"] += reclaimed
+
+    logger.info("Media GC %s: %s", "found" if dry_run else "reclaimed", dict(report))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete orphaned media attachments and their files")
+    parser.add_argument("--dry-run", action="store_true", help="only report orphans, do not delete them")
+    parser.add_argument("--batch-size", type=int, default=GC_BATCH_SIZE)
+    parser.add_argument("--grace-period", type=int, default=int(GC_GRACE_PERIOD.total_seconds()), help="seconds")
+    parser.add_argument("--pause", type=float, default=GC_BATCH_PAUSE, help="seconds between batches")
+    args = parser.parse_args()
+
+    print(
+        asyncio.run(
+            collect_orphans(
+                batch_size=args.batch_size,
+                grace_period=timedelta(seconds=args.grace_period),
+                pause=args.pause,
+                dry_run=args.dry_run,
+            )
+        )
+    )
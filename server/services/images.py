@@ -0,0 +1,121 @@
+"""
+CPU-bound image processing for uploaded media.
+
+strip_metadata() and make_variants() run in a worker process of a ProcessPoolExecutor, so decoding and
+re-encoding never block the uvicorn event loop. This module imports nothing from the application, which keeps
+the worker processes light.
+"""
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+
+# Longest side in pixels of every variant; None keeps the original dimensions
+VARIANT_SIZES: Dict[str, Optional[int]] = {"thumb": 150, "small": 480, "medium": 1080, "full": None}
+VARIANT_FORMAT = "WEBP"
+VARIANT_QUALITY = 80
+# Uploads in these formats are rewritten without their metadata before they are stored
+STRIP_FORMATS = ("JPEG", "PNG", "WEBP")
+STRIP_QUALITY = 95
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def variant_path(source_path: str, name: str) -> str:
+    source = Path(source_path)
+    return str(source.with_name(f"{source.stem}_{name}.{VARIANT_FORMAT.lower()}"))
+
+
+def strip_metadata(path: str) -> bool:
+    """
+    Rewrite the image at path in its own format without EXIF, GPS, XMP and comments, so that the original is
+    as safe to serve as its variants. The EXIF orientation of still images is applied first; JPEGs that need no
+    rotation keep their quantization tables and barely change. Other files are left alone. Return whether the
+    file was rewritten.
+    """
+    temp_path = path + ".part"
+    try:
+        with Image.open(path) as original:
+            if original.format not in STRIP_FORMATS:
+                return False
+            # The ICC profile is colour data, not metadata about the picture, and is kept
+            options = {"exif": b"", "xmp": b"", "comment": b"", "icc_profile": original.info.get("icc_profile")}
+            if getattr(original, "n_frames", 1) > 1:
+                original.save(temp_path, original.format, save_all=True, quality=STRIP_QUALITY, **options)
+            elif original.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+                ImageOps.exif_transpose(original).save(temp_path, original.format, quality=STRIP_QUALITY, **options)
+            else:
+                quality = "keep" if original.format == "JPEG" else STRIP_QUALITY
+                original.save(temp_path, original.format, quality=quality, **options)
+        os.replace(temp_path, path)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    return True
+
+
+def make_variants(source_path: str) -> Dict[str, str]:
+    """
+    Write every size variant of the image next to it and return {variant name: path}.
+
+    Variants are re-encoded from pixels only, so EXIF, GPS and other metadata are dropped; the EXIF orientation
+    is applied first so that the picture stays upright. Files that are not images give an empty dict. Variants
+    that already exist (the same blob uploaded again) are not encoded twice.
+    """
+    variants = {name: variant_path(source_path, name) for name in VARIANT_SIZES}
+    if all(Path(path).exists() for path in variants.values()):
+        return variants
+
+    try:
+        with Image.open(source_path) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+            for name, max_side in VARIANT_SIZES.items():
+                out_path = Path(variants[name])
+                if out_path.exists():
+                    continue
+                variant = image.copy()
+                if max_side:
+                    variant.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+                # Write under a temporary name so that a half-written variant is never served
+                temp_path = out_path.with_name(out_path.name + ".part")
+                variant.save(temp_path, VARIANT_FORMAT, quality=VARIANT_QUALITY)
+                os.replace(temp_path, out_path)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return {}
+
+    return variants
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn instead of fork: the parent runs an event loop and aiofile threads that must not be copied
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def strip_metadata_in_pool(path: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), strip_metadata, path)
+
+
+async def make_variants_in_pool(source_path: str) -> Dict[str, str]:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), make_variants, source_path)
@@ -0,0 +1,81 @@
+import os
+import re
+from functools import partial
+from pathlib import Path
+
+from fastapi import UploadFile
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import on_rollback
+from logger_config import get_logger
+from services.images import VARIANT_SIZES, make_variants_in_pool, strip_metadata_in_pool, variant_path
+from services.metrics import MEDIA_BYTES_WRITTEN
+from services.service import AttachmentDAO, BlobDAO
+from services.utils import FileHandleService, remove_media_file
+
+logger = get_logger("app_logger.services")
+
+# Blob files are named <sha256>[-<generation>].<ext>
+_CONTENT_HASH = re.compile(r"[0-9a-f]{64}")
+
+
+async def store_upload(session: AsyncSession, file: UploadFile):
+    """
+    Save an upload in the content-addressed store and create its Attachment row.
+
+    The file is streamed to a temporary name while it is hashed, and images are rewritten without their EXIF,
+    GPS and other metadata before anybody can fetch them; the hash stays that of the uploaded bytes. If a blob
+    with the same SHA-256 already exists the copy is dropped and the blob gains a reference, otherwise the copy
+    is renamed to the path of the new blob, under its content lock. Identical bytes are therefore stored once,
+    however many times they are uploaded. Whatever fails afterwards, the rollback removes the file again: its
+    path is new, so it cannot belong to anybody else.
+    """
+    fileservice = FileHandleService(file)
+    _, temp_path = await fileservice.save()
+
+    try:
+        await strip_metadata_in_pool(temp_path)
+        blob_id, path, created = await BlobDAO.acquire(
+            session, sha256=fileservice.sha256, path=fileservice.content_path(), size=os.path.getsize(temp_path)
+        )
+        if created:
+            os.replace(temp_path, path)
+            on_rollback(session, partial(remove_media_file, path))
+        else:
+            await fileservice.delete(filepath=temp_path)
+            logger.debug("The file %s is a duplicate of %s", file.filename, path)
+
+        return await AttachmentDAO.add(session, path=path, blob_id=blob_id)
+
+    except Exception:
+        await fileservice.delete(filepath=temp_path)
+        logger.debug("The file %s was deleted due to an error", temp_path)
+        raise
+
+
+async def remove_unreferenced_file(session: AsyncSession, path: str) -> bool:
+    """
+    Remove a stored file and its variants unless a blob keeps its file at path again. The check and the
+    removal happen under the content lock, held until the caller's transaction ends, so a late or retried
+    removal never deletes the file of a blob created in the meantime. Return whether the file was removed.
+    """
+    content_hash = _CONTENT_HASH.match(Path(path).name)
+    # Files uploaded before the content-addressed store belong to their attachment alone
+    if content_hash is not None:
+        await BlobDAO.lock(session, content_hash.group())
+        if await BlobDAO.is_stored_at(session, content_hash.group(), path):
+            logger.info("The file %s belongs to a blob again and is kept", path)
+            return False
+    remove_media_file(path)
+    return True
+
+
+async def process_attachment(session: AsyncSession, attachment_id: int, path: str):
+    """Post-upload stage: build the image variants in the process pool and record them on the attachment"""
+    # Variants of a blob uploaded before already exist and are not written again
+    missing = [variant_path(path, name) for name in VARIANT_SIZES if not os.path.exists(variant_path(path, name))]
+    variants = await make_variants_in_pool(path)
+    if variants:
+        MEDIA_BYTES_WRITTEN.labels("variant").inc(sum(os.path.getsize(p) for p in missing if os.path.exists(p)))
+        await AttachmentDAO.set_variants(session, attachment_id, variants)
+    return variants
@@ -0,0 +1,73 @@
+"""
+Prometheus metrics, served as text by GET /metrics.
+
+Recording a sample only touches the value of one metric child, so it costs an uncontended lock at most.
+With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by them (and wiped
+before every start): each process then keeps its samples in its own memory-mapped file and /metrics
+aggregates the files of all workers, whichever worker answers the scrape.
+"""
+
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Requests that match no route share one label value, so that scanners cannot blow up the label set
+UNMATCHED_ROUTE = "unmatched"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by route template",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests being handled right now",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+DAO_LATENCY = Histogram(
+    "dao_call_duration_seconds",
+    "Time spent in a DAO method, queries included",
+    ["dao", "method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+DAO_ERRORS = Counter(
+    "dao_call_errors_total",
+    "DAO method calls that raised",
+    ["dao", "method", "error"],
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool, connecting included",
+    ["engine"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Pooled connections checked out, and opened beyond the pool size",
+    ["engine", "state"],
+    multiprocess_mode="livesum",
+)
+MEDIA_BYTES_WRITTEN = Counter(
+    "media_bytes_written_total",
+    "Bytes written to MEDIA_DIR",
+    ["kind"],
+)
+
+
+def render() -> bytes:
+    """Current samples in the Prometheus text exposition format"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead():
+    """Drop the in-flight gauge of this worker once it exits; its counters and histograms are kept"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,63 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Callable, Optional, Sequence, Tuple
+
+from fastapi.exceptions import HTTPException
+from sqlalchemy import Row
+
+Cursor = Tuple[datetime, int]
+RankCursor = Tuple[float, int]
+
+
+def _pack(*values) -> str:
+    raw = "|".join(str(value) for value in values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _unpack(cursor: str, *types):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        values = raw.rsplit("|", len(types) - 1)
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return tuple(to_type(value) for to_type, value in zip(types, values))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Pack a (created_at, id) keyset position into an opaque url-safe token"""
+    return _pack(created_at.isoformat(), row_id)
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Cursor]:
+    """Unpack a token produced by encode_cursor, answering 400 to anything else"""
+    if not cursor:
+        return None
+    return _unpack(cursor, datetime.fromisoformat, int)
+
+
+def encode_rank_cursor(rank: float, row_id: int) -> str:
+    """Pack a (rank, id) keyset position of a ranked search; repr() keeps the float exact"""
+    return _pack(repr(rank), row_id)
+
+
+def decode_rank_cursor(cursor: Optional[str]) -> Optional[RankCursor]:
+    if not cursor:
+        return None
+    return _unpack(cursor, float, int)
+
+
+def split_page(
+    rows: Sequence[Row], limit: int, encode: Callable[[Row], str] = lambda row: encode_cursor(row.created_at, row.id)
+) -> Tuple[Sequence[Row], Optional[str]]:
+    """
+    Cut rows fetched with `limit + 1` down to one page.
+
+    The extra row only tells whether another page exists; the cursor points at the last row that is returned.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode(rows[-1])
@@ -0,0 +1,127 @@
+"""
+Request-scoped SQL accounting.
+
+While a tracker is active every statement run by any engine in the current context is counted in it:
+the number of queries, the time spent waiting for the database and how often each statement shape ran.
+The shape is the statement text with expanded IN lists collapsed, so the same lookup repeated for every
+row of a page (an N+1) shows up as one shape with a large count.
+
+    with track_queries() as stats:
+        ...
+    stats.count, stats.duration, stats.repeated()
+
+`query_budget` fails with QueryBudgetExceeded when the block runs more queries than declared; the
+middleware tracks every request, warns about repeated shapes and, with QUERY_STATS_HEADER=true,
+reports the numbers in an X-Query-Stats response header.
+"""
+
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from logger_config import get_logger
+
+logger = get_logger("app_logger.services")
+
+QUERY_STATS = os.getenv("QUERY_STATS", "true").lower() == "true"
+QUERY_STATS_HEADER = os.getenv("QUERY_STATS_HEADER", "false").lower() == "true"
+# A statement shape run this many times within one request is logged as a likely N+1, 0 turns the warning off
+QUERY_REPEAT_WARNING = int(os.getenv("QUERY_REPEAT_WARNING", 5))
+
+# "$1, $2, $3" (asyncpg) or "?, ?, ?" (sqlite) of an expanded IN list, whatever its length
+_PLACEHOLDER_LIST = re.compile(r"(?:\$\d+|\?)(?:\s*,\s*(?:\$\d+|\?))*")
+
+_trackers: ContextVar[Tuple["QueryStats", ...]] = ContextVar("query_trackers", default=())
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes: Counter = Counter()
+
+    def record(self, shape: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        self.shapes[shape] += 1
+
+    def repeated(self, min_count: int = 2) -> Dict[str, int]:
+        """{statement shape: times run} of the shapes that ran at least min_count times"""
+        return {shape: count for shape, count in self.shapes.most_common() if count >= min_count}
+
+    def header(self) -> str:
+        repeats = max(self.shapes.values(), default=0)
+        return f"count={self.count}; db_ms={self.duration * 1000:.2f}; shapes={len(self.shapes)}; max_repeat={repeats}"
+
+    def describe(self) -> str:
+        lines = [f"{count} x {shape}" for shape, count in self.shapes.most_common()]
+        return "\n".join([f"{self.count} queries in {self.duration * 1000:.2f}ms:", *lines])
+
+
+def statement_shape(statement: str) -> str:
+    return _PLACEHOLDER_LIST.sub("?", " ".join(statement.split()))
+
+
+@contextmanager
+def track_queries():
+    """Count the statements run in this context, nested trackers included, until the block exits"""
+    stats = QueryStats()
+    token = _trackers.set(_trackers.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _trackers.reset(token)
+
+
+@contextmanager
+def query_budget(max_queries: int):
+    """Fail the block when it runs more than max_queries statements"""
+    with track_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        raise QueryBudgetExceeded(f"The budget is {max_queries} queries, ran {stats.describe()}")
+
+
+def warn_repeated(stats: QueryStats, where: str):
+    if not QUERY_REPEAT_WARNING:
+        return
+    for shape, count in stats.repeated(QUERY_REPEAT_WARNING).items():
+        logger.warning("Possible N+1 in %s: statement ran %s times: %.300s", where, count, shape)
+
+
+# Registered on the Engine class, so the app engine and any test engine are accounted alike
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if _trackers.get():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    trackers = _trackers.get()
+    starts = conn.info.get("query_start")
+    if trackers and starts:
+        duration = time.perf_counter() - starts.pop()
+        shape = statement_shape(statement)
+        for stats in trackers:
+            stats.record(shape, duration)
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    if exception_context.connection is not None:
+        starts = exception_context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
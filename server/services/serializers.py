@@ -0,0 +1,45 @@
+"""
+Feed pages serialized straight from row tuples to JSON bytes.
+
+The generic path builds dicts, validates them into TweetFull/TweetGetResponse, dumps them back to dicts
+and lets JSONResponse encode those with the json module. Here every tweet is encoded once by orjson, with
+the keys in the declaration order of the schemas, into a fragment that can be cached and spliced into pages.
+The output is byte-for-byte what JSONResponse(TweetGetResponse(...).model_dump()) produces: compact
+separators and non-ASCII left as UTF-8.
+"""
+
+from typing import List, Optional, Sequence
+
+import orjson
+from fastapi.responses import Response
+from sqlalchemy import Row
+
+
+class JSONBytesResponse(Response):
+    """Response for a body that is already serialized JSON"""
+
+    media_type = "application/json"
+
+
+def tweet_to_dict(row: Row, likes: List[dict], attachments: List[str]) -> dict:
+    # Same keys and order as schemas.TweetFull
+    return {
+        "id": row.id,
+        "content": row.content,
+        "attachments": attachments,
+        "author": {"id": row.user_id, "name": row.name},
+        "likes": likes,
+        "like_count": row.like_count,
+    }
+
+
+def tweet_fragment(row: Row, likes: List[dict], attachments: List[str]) -> bytes:
+    """One element of TweetGetResponse.tweets, ready to be spliced into a page"""
+    return orjson.dumps(tweet_to_dict(row, likes, attachments))
+
+
+def feed_page_to_bytes(fragments: Sequence[bytes], next_cursor: Optional[str]) -> bytes:
+    """Encode a feed page as schemas.TweetGetResponse would be, from the fragments of its tweets"""
+    return b"".join(
+        (b'{"result":true,"tweets":[', b",".join(fragments), b'],"next_cursor":', orjson.dumps(next_cursor), b"}")
+    )
@@ -1,36 +1,644 @@
-from typing import List
+import html
+import os
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import (
+    Integer,
+    case,
+    column,
+    delete,
+    event,
+    func,
+    literal,
+    literal_column,
+    select,
+    true,
+    tuple_,
+    union,
+    union_all,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import object_session
 
-from models import Attachment, Follower, Like, Tweet, User
+from database import on_commit
+from models import Attachment, Blob, Follower, Like, Timeline, Tweet, TweetAttachment, User
+from schemas import UserPydantic
 from services.base import BaseDAO
+from services.cache import auth_cache, feed_cache, fragment_cache
+from services.jobs import enqueue
+from services.pagination import Cursor, RankCursor
 from services.utils import logger_decorator
 
+# Authors with more followers than this are not fanned out on write; their tweets are merged in at read time
+TIMELINE_FANOUT_LIMIT = int(os.getenv("TIMELINE_FANOUT_LIMIT", 10000))
+# Text search configuration of the gix_tweet_content_ru index; the query must repeat its expression to use it
+TS_CONFIG = literal_column("'russian'::regconfig")
+# ts_headline marks matches with control characters, removed from the content first; highlight_html() escapes
+# the fragments and only then turns the marks into <b></b>, so a tweet can never inject markup into a highlight
+HIGHLIGHT_START, HIGHLIGHT_STOP = "\x02", "\x03"
+TS_HEADLINE_OPTIONS = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2, MaxWords=20, MinWords=5"
+# Number of recent tweets copied into a timeline when its owner follows somebody
+TIMELINE_BACKFILL_SIZE = int(os.getenv("TIMELINE_BACKFILL_SIZE", 50))
+
+
+class SearchMatch(NamedTuple):
+    id: int
+    rank: float
+    highlight: str
+
+
+def highlight_html(fragments: str) -> str:
+    """HTML-escape ts_headline fragments and wrap the marked matches in <b></b>"""
+    return html.escape(fragments).replace(HIGHLIGHT_START, "<b>").replace(HIGHLIGHT_STOP, "</b>")
+
 
 class UserDAO(BaseDAO[User]):
     model = User
 
+    @classmethod
+    @logger_decorator
+    async def find_auth_user(cls, session: AsyncSession, api_key: str) -> Optional[UserPydantic]:
+        """Resolve an Api-Key with a single indexed lookup that reads only id and name"""
+        query = select(cls.model.id, cls.model.name).where(cls.model.api_key == api_key)
+        result = await session.execute(query)
+        row = result.one_or_none()
+        return UserPydantic(id=row.id, name=row.name) if row else None
+
+    @classmethod
+    @logger_decorator
+    async def find_version(cls, session: AsyncSession, user_id: int):
+        """
+        Return (updated_at, followers_count, following_count) of the user, or None when there is no such user.
+        Following or unfollowing moves the counters of both users, so the stamp changes with the profile.
+        """
+        query = select(cls.model.updated_at, cls.model.followers_count, cls.model.following_count).where(
+            cls.model.id == user_id
+        )
+        result = await session.execute(query)
+        return result.one_or_none()
+
+    @classmethod
+    @logger_decorator
+    async def change_follow_counts_many(cls, session: AsyncSession, pairs: List[Tuple[int, int]], delta: int):
+        """
+        Move following_count of the followers and followers_count of the followed users by delta for many
+        (user_id, followed_user_id) pairs in one UPDATE
+        """
+        if not pairs:
+            return
+        following = Counter(user_id for user_id, _ in pairs)
+        followers = Counter(followed_user_id for _, followed_user_id in pairs)
+        following_delta = case({key: count * delta for key, count in following.items()}, value=cls.model.id, else_=0)
+        followers_delta = case({key: count * delta for key, count in followers.items()}, value=cls.model.id, else_=0)
+        query = (
+            update(cls.model)
+            .where(cls.model.id.in_(sorted(following.keys() | followers.keys())))
+            .values(
+                following_count=func.greatest(cls.model.following_count + following_delta, 0),
+                followers_count=func.greatest(cls.model.followers_count + followers_delta, 0),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
+
+    @classmethod
+    @logger_decorator
+    async def add(cls, session: AsyncSession, **kwargs):
+        record = await super().add(session, **kwargs)
+        on_commit(session, auth_cache.clear)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def delete(cls, session: AsyncSession, **kwargs):
+        record = await super().delete(session, **kwargs)
+        on_commit(session, auth_cache.clear)
+        return record
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_auth_cache(mapper, connection, target):
+    # Users changed through the unit of work rather than UserDAO
+    session = object_session(target)
+    if session is not None:
+        on_commit(session, auth_cache.clear)
+
+
+class TimelineDAO(BaseDAO[Timeline]):
+    model = Timeline
+
+    @classmethod
+    @logger_decorator
+    async def is_fanout_author(cls, session: AsyncSession, user_id: int) -> bool:
+        """Tell whether the author is small enough to fan out on write"""
+        followers_count = await session.scalar(select(User.followers_count).where(User.id == user_id))
+        return (followers_count or 0) <= TIMELINE_FANOUT_LIMIT
+
+    @classmethod
+    @logger_decorator
+    async def fan_out(cls, session: AsyncSession, tweet: Tweet):
+        """Write the tweet into its author's timeline and, unless the author is too popular, into every follower's"""
+        columns = ["user_id", "tweet_id", "author_id", "created_at"]
+        rows = select(literal(tweet.user_id), literal(tweet.id), literal(tweet.user_id), literal(tweet.created_at))
+        if await cls.is_fanout_author(session, tweet.user_id):
+            followers = select(
+                Follower.user_id, literal(tweet.id), literal(tweet.user_id), literal(tweet.created_at)
+            ).where(Follower.followed_user_id == tweet.user_id)
+            rows = rows.union_all(followers)
+
+        # Selecting from a subquery lets SQLAlchemy add the id sequence and updated_at defaults to the INSERT
+        query = insert(cls.model).from_select(columns, select(rows.subquery())).on_conflict_do_nothing()
+        await session.execute(query)
+
+    @classmethod
+    @logger_decorator
+    async def backfill_many(cls, session: AsyncSession, pairs: List[Tuple[int, int]]):
+        """
+        Copy the authors' latest tweets into the timelines of their new followers, for many (user_id, author_id)
+        pairs: one INSERT over a LATERAL join of the pairs
+        """
+        if not pairs:
+            return
+        follows = values(column("user_id", Integer), column("author_id", Integer), name="follows").data(pairs)
+        await cls._backfill(session, follows)
+
+    @classmethod
+    @logger_decorator
+    async def backfill_range(cls, session: AsyncSession, first_user_id: int, last_user_id: int) -> int:
+        """
+        Materialize the timelines of users with first_user_id <= id <= last_user_id from what they follow:
+        their own latest tweets and those of every author who is fanned out on write. Rows that are already
+        there are kept. Return the number of rows written.
+        """
+        own = select(User.id.label("user_id"), User.id.label("author_id")).where(
+            User.id.between(first_user_id, last_user_id)
+        )
+        followed = (
+            select(Follower.user_id, Follower.followed_user_id)
+            .join(User, User.id == Follower.followed_user_id)
+            .where(
+                Follower.user_id.between(first_user_id, last_user_id), User.followers_count <= TIMELINE_FANOUT_LIMIT
+            )
+        )
+        return await cls._backfill(session, union_all(own, followed).subquery("follows"))
+
+    @classmethod
+    async def _backfill(cls, session: AsyncSession, follows) -> int:
+        """Copy the latest tweets of follows.c.author_id into the timeline of follows.c.user_id, one INSERT"""
+        latest = (
+            select(Tweet.id, Tweet.user_id, Tweet.created_at)
+            .where(Tweet.user_id == follows.c.author_id)
+            .order_by(Tweet.created_at.desc(), Tweet.id.desc())
+            .limit(TIMELINE_BACKFILL_SIZE)
+            .lateral()
+        )
+        rows = select(follows.c.user_id, latest.c.id, latest.c.user_id, latest.c.created_at).select_from(
+            follows.join(latest, true())
+        )
+        query = (
+            insert(cls.model)
+            .from_select(["user_id", "tweet_id", "author_id", "created_at"], select(rows.subquery()))
+            .on_conflict_do_nothing()
+        )
+        result = await session.execute(query)
+        return result.rowcount
+
+    @classmethod
+    @logger_decorator
+    async def remove_authors(cls, session: AsyncSession, pairs: List[Tuple[int, int]]):
+        """Drop the authors' tweets from the timelines of users who unfollowed them, for (user_id, author_id) pairs"""
+        if not pairs:
+            return
+        query = delete(cls.model).where(tuple_(cls.model.user_id, cls.model.author_id).in_(pairs))
+        await session.execute(query)
+
+    @classmethod
+    @logger_decorator
+    async def find_tweet_refs(cls, session: AsyncSession, user_id: int, limit: int, before: Optional[Cursor] = None):
+        """
+        Return up to `limit` (id, created_at) tweet references of the user's home timeline, newest first.
+
+        Materialized rows are read from the (user_id, created_at, tweet_id) index and merged with the latest tweets
+        of followed accounts that are too popular to be fanned out on write.
+        """
+        materialized = select(cls.model.tweet_id.label("id"), cls.model.created_at).where(cls.model.user_id == user_id)
+
+        popular_authors = (
+            select(Follower.followed_user_id)
+            .join(User, User.id == Follower.followed_user_id)
+            .where(Follower.user_id == user_id, User.followers_count > TIMELINE_FANOUT_LIMIT)
+        )
+        pulled = select(Tweet.id, Tweet.created_at).where(Tweet.user_id.in_(popular_authors))
+
+        if before is not None:
+            materialized = materialized.where(tuple_(cls.model.created_at, cls.model.tweet_id) < tuple_(*before))
+            pulled = pulled.where(tuple_(Tweet.created_at, Tweet.id) < tuple_(*before))
+
+        materialized = materialized.order_by(cls.model.created_at.desc(), cls.model.tweet_id.desc()).limit(limit)
+        pulled = pulled.order_by(Tweet.created_at.desc(), Tweet.id.desc()).limit(limit)
+
+        # UNION also drops duplicates of tweets materialized before their author crossed the fan-out limit
+        refs = union(materialized, pulled).subquery()
+        query = select(refs.c.id, refs.c.created_at).order_by(refs.c.created_at.desc(), refs.c.id.desc()).limit(limit)
+        result = await session.execute(query)
+        return result.all()
+
 
 class FollowerDAO(BaseDAO[Follower]):
+    """
+    Follows are written with ON CONFLICT DO NOTHING and deleted only if they exist, so following twice or
+    unfollowing a stranger is a no-op; _follows_changed moves the counters and timelines of what was written.
+    add, delete and add_many are the same operations under the base class names.
+    """
+
     model = Follower
 
+    @classmethod
+    async def add(cls, session: AsyncSession, **kwargs):
+        return await cls.add_or_ignore(session, **kwargs)
+
+    @classmethod
+    async def delete(cls, session: AsyncSession, **kwargs):
+        return await cls.delete_if_exists(session, **kwargs)
+
+    @classmethod
+    async def add_many(cls, session: AsyncSession, rows: List[dict]):
+        return await cls.add_many_or_ignore(session, rows)
+
+    @classmethod
+    @logger_decorator
+    async def add_or_ignore(cls, session: AsyncSession, **kwargs):
+        record = await super().add_or_ignore(session, **kwargs)
+        await cls._follows_changed(session, [record] if record is not None else [], delta=1)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def delete_if_exists(cls, session: AsyncSession, **kwargs):
+        record = await super().delete_if_exists(session, **kwargs)
+        await cls._follows_changed(session, [record] if record is not None else [], delta=-1)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def add_many_or_ignore(cls, session: AsyncSession, rows: List[dict]):
+        records = await super().add_many_or_ignore(session, rows)
+        await cls._follows_changed(session, records, delta=1)
+        return records
+
+    @classmethod
+    @logger_decorator
+    async def delete_many(cls, session: AsyncSession, keys: List[dict]):
+        records = await super().delete_many(session, keys)
+        await cls._follows_changed(session, records, delta=-1)
+        return records
+
+    @classmethod
+    async def _follows_changed(cls, session: AsyncSession, records: List[Follower], delta: int):
+        pairs = [(record.user_id, record.followed_user_id) for record in records]
+        await UserDAO.change_follow_counts_many(session, pairs, delta=delta)
+        if delta > 0:
+            await TimelineDAO.backfill_many(session, pairs)
+        else:
+            await TimelineDAO.remove_authors(session, pairs)
+
 
 class LikeDAO(BaseDAO[User]):
+    """As FollowerDAO: likes are idempotent, and _count_likes moves the like counters of what was written"""
+
     model = Like
 
+    @classmethod
+    async def add(cls, session: AsyncSession, **kwargs):
+        return await cls.add_or_ignore(session, **kwargs)
+
+    @classmethod
+    async def delete(cls, session: AsyncSession, **kwargs):
+        return await cls.delete_if_exists(session, **kwargs)
+
+    @classmethod
+    async def add_many(cls, session: AsyncSession, rows: List[dict]):
+        return await cls.add_many_or_ignore(session, rows)
+
+    @classmethod
+    @logger_decorator
+    async def add_or_ignore(cls, session: AsyncSession, **kwargs):
+        record = await super().add_or_ignore(session, **kwargs)
+        await cls._count_likes(session, [record] if record is not None else [], delta=1)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def delete_if_exists(cls, session: AsyncSession, **kwargs):
+        record = await super().delete_if_exists(session, **kwargs)
+        await cls._count_likes(session, [record] if record is not None else [], delta=-1)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def add_many_or_ignore(cls, session: AsyncSession, rows: List[dict]):
+        records = await super().add_many_or_ignore(session, rows)
+        await cls._count_likes(session, records, delta=1)
+        return records
+
+    @classmethod
+    @logger_decorator
+    async def delete_many(cls, session: AsyncSession, keys: List[dict]):
+        records = await super().delete_many(session, keys)
+        await cls._count_likes(session, records, delta=-1)
+        return records
+
+    @classmethod
+    async def _count_likes(cls, session: AsyncSession, records: List[Like], delta: int):
+        deltas = Counter()
+        for record in records:
+            deltas[record.tweet_id] += delta
+        await TweetDAO.change_like_counts(session, deltas)
+        if deltas:
+            on_commit(session, feed_cache.clear)
+        for tweet_id in deltas:
+            on_commit(session, partial(fragment_cache.delete, tweet_id))
+
+    @classmethod
+    @logger_decorator
+    async def find_likers_by_tweet_ids(cls, session: AsyncSession, tweet_ids: List[int]):
+        """Return (tweet_id, user_id, name) rows for every like on the given tweets in one query"""
+        query = (
+            select(cls.model.tweet_id, cls.model.user_id, User.name)
+            .join(User, User.id == cls.model.user_id)
+            .where(cls.model.tweet_id.in_(tweet_ids))
+            .order_by(cls.model.id)
+        )
+        result = await session.execute(query)
+        return result.all()
+
 
 class TweetDAO(BaseDAO[Tweet]):
     model = Tweet
 
+    @classmethod
+    @logger_decorator
+    async def add(cls, session: AsyncSession, **kwargs):
+        record = await super().add(session, **kwargs)
+        # Followers' timelines are written by the job worker once the tweet is committed
+        await enqueue(session, "timeline.fan_out", tweet_id=record.id)
+        on_commit(session, feed_cache.clear)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def delete(cls, session: AsyncSession, **kwargs):
+        record = await super().delete(session, **kwargs)
+        on_commit(session, feed_cache.clear)
+        on_commit(session, partial(fragment_cache.delete, record.id))
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def change_like_counts(cls, session: AsyncSession, deltas: Dict[int, int]):
+        """Move like_count of many tweets by {tweet_id: delta} in one UPDATE"""
+        if not deltas:
+            return
+        query = (
+            update(cls.model)
+            .where(cls.model.id.in_(list(deltas)))
+            .values(like_count=func.greatest(cls.model.like_count + case(deltas, value=cls.model.id, else_=0), 0))
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
+
+    @classmethod
+    def _feed_query(cls):
+        return select(
+            cls.model.id,
+            cls.model.content,
+            cls.model.user_id,
+            User.name,
+            cls.model.like_count,
+            cls.model.created_at,
+            cls.model.updated_at,
+        ).join(User, User.id == cls.model.user_id)
+
+    @classmethod
+    @logger_decorator
+    async def find_feed_refs(cls, session: AsyncSession, limit: int, before: Optional[Cursor] = None):
+        """
+        Return up to `limit` (id, created_at, updated_at) rows of the feed, newest first.
+
+        Paging is keyset based on (created_at, id), so a deep page costs the same index range scan as the first one.
+        updated_at is the version of the tweet's rendered fragment.
+        """
+        query = (
+            select(cls.model.id, cls.model.created_at, cls.model.updated_at)
+            .order_by(cls.model.created_at.desc(), cls.model.id.desc())
+            .limit(limit)
+        )
+        if before is not None:
+            query = query.where(tuple_(cls.model.created_at, cls.model.id) < tuple_(*before))
+        result = await session.execute(query)
+        return result.all()
+
+    @classmethod
+    @logger_decorator
+    async def find_versions(cls, session: AsyncSession, tweet_ids: List[int]):
+        """Return {tweet_id: updated_at} of the given tweets that still exist"""
+        if not tweet_ids:
+            return {}
+        result = await session.execute(select(cls.model.id, cls.model.updated_at).where(cls.model.id.in_(tweet_ids)))
+        return dict(result.all())
+
+    @classmethod
+    @logger_decorator
+    async def find_feed_rows_by_ids(cls, session: AsyncSession, tweet_ids: List[int]):
+        """
+        Return (id, content, user_id, name, like_count, created_at, updated_at) rows for the given ids,
+        keeping the order of tweet_ids
+        """
+        if not tweet_ids:
+            return []
+        result = await session.execute(cls._feed_query().where(cls.model.id.in_(tweet_ids)))
+        rows = {row.id: row for row in result.all()}
+        return [rows[tweet_id] for tweet_id in tweet_ids if tweet_id in rows]
+
+    @classmethod
+    @logger_decorator
+    async def search(cls, session: AsyncSession, q: str, limit: int, before: Optional[RankCursor] = None):
+        """
+        Full-text search over the gix_tweet_content_ru GIN index.
+
+        Return up to `limit` SearchMatch rows ordered by ts_rank and id, keyset-paginated on (rank, id).
+        ts_headline is only computed for the rows of the returned page; highlights are HTML (see highlight_html).
+        """
+        tsquery = func.websearch_to_tsquery(TS_CONFIG, q)
+        vector = func.to_tsvector(TS_CONFIG, cls.model.content)
+        rank = func.ts_rank(vector, tsquery)
+
+        matches = select(cls.model.id, cls.model.content, rank.label("rank")).where(vector.op("@@")(tsquery))
+        if before is not None:
+            matches = matches.where(tuple_(rank, cls.model.id) < tuple_(*before))
+        matches = matches.order_by(rank.desc(), cls.model.id.desc()).limit(limit).subquery()
+
+        content = func.translate(matches.c.content, HIGHLIGHT_START + HIGHLIGHT_STOP, "")
+        highlight = func.ts_headline(TS_CONFIG, content, tsquery, TS_HEADLINE_OPTIONS)
+        query = select(matches.c.id, matches.c.rank, highlight.label("highlight")).order_by(
+            matches.c.rank.desc(), matches.c.id.desc()
+        )
+        result = await session.execute(query)
+        return [SearchMatch(row.id, row.rank, highlight_html(row.highlight)) for row in result.all()]
+
+
+class BlobDAO(BaseDAO[Blob]):
+    model = Blob
+
+    @classmethod
+    @logger_decorator
+    async def acquire(cls, session: AsyncSession, sha256: str, path: str, size: int):
+        """
+        Take a reference to the blob with this content hash, creating it when it does not exist yet.
+        Return (id, path, created); when created is False the caller's copy of the file is redundant.
+        Holds the content lock until the transaction ends, so the caller can move the file into place under it.
+        """
+        await cls.lock(session, sha256)
+        for _ in range(3):
+            query = (
+                insert(cls.model)
+                .values(sha256=sha256, path=path, size=size, ref_count=1)
+                .on_conflict_do_nothing(index_elements=["sha256"])
+                .returning(cls.model.id, cls.model.path)
+            )
+            row = (await session.execute(query)).one_or_none()
+            if row is not None:
+                return row.id, row.path, True
+
+            query = (
+                update(cls.model)
+                .where(cls.model.sha256 == sha256)
+                .values(ref_count=cls.model.ref_count + 1)
+                .returning(cls.model.id, cls.model.path)
+                .execution_options(synchronize_session=False)
+            )
+            row = (await session.execute(query)).one_or_none()
+            if row is not None:
+                return row.id, row.path, False
+            # The last reference was released between both statements: create the blob again
+
+        raise RuntimeError(f"Could not acquire blob {sha256}")
+
+    @classmethod
+    @logger_decorator
+    async def release(cls, session: AsyncSession, blob_id: int, count: int = 1):
+        """
+        Drop `count` references; when none is left delete the blob row and return its (path, size),
+        the file itself is for the caller to remove once the transaction commits
+        """
+        query = (
+            update(cls.model)
+            .where(cls.model.id == blob_id)
+            .values(ref_count=cls.model.ref_count - count)
+            .returning(cls.model.ref_count, cls.model.path, cls.model.size)
+            .execution_options(synchronize_session=False)
+        )
+        row = (await session.execute(query)).one_or_none()
+        if row is None or row.ref_count > 0:
+            return None
+
+        await session.execute(delete(cls.model).where(cls.model.id == blob_id, cls.model.ref_count <= 0))
+        return row
+
+    @classmethod
+    @logger_decorator
+    async def lock(cls, session: AsyncSession, sha256: str):
+        """
+        Take the transaction-level advisory lock of the content hash, which serializes creating
+        a blob's file with removing the file of an earlier blob of the same bytes
+        """
+        lock = select(func.pg_advisory_xact_lock(func.hashtext(sha256))).execution_options(replica_reads=False)
+        await session.execute(lock)
+
+    @classmethod
+    @logger_decorator
+    async def is_stored_at(cls, session: AsyncSession, sha256: str, path: str) -> bool:
+        """Tell whether a blob still keeps its file at path"""
+        query = select(cls.model.id).where(cls.model.sha256 == sha256, cls.model.path == path)
+        return await session.scalar(query) is not None
+
 
 class AttachmentDAO(BaseDAO[User]):
     model = Attachment
 
     @classmethod
     @logger_decorator
-    async def find_attachments_path_by_tweet_id(cls, session: AsyncSession, tweet_ids: List[int]):
-        query = select(cls.model.path).where(cls.model.id.in_(tweet_ids))
+    async def delete(cls, session: AsyncSession, **kwargs):
+        record = await super().delete(session, **kwargs)
+        if record.blob_id is not None:
+            released = await BlobDAO.release(session, record.blob_id)
+            if released:
+                # The file goes only once the blob row is gone for good
+                await enqueue(session, "media.remove_file", path=released.path)
+        return record
+
+    @classmethod
+    @logger_decorator
+    async def find_paths_by_tweet_ids(cls, session: AsyncSession, tweet_ids: List[int], size: Optional[str] = None):
+        """
+        Return {tweet_id: [path, ...]} for all given tweets in one join over tweet_attachment, in posting order.
+        With `size`, the path of that variant is returned wherever it exists.
+        """
+        query = (
+            select(TweetAttachment.tweet_id, cls.model.path, cls.model.variants)
+            .join(cls.model, cls.model.id == TweetAttachment.attachment_id)
+            .where(TweetAttachment.tweet_id.in_(tweet_ids))
+            .order_by(TweetAttachment.tweet_id, TweetAttachment.position)
+        )
         result = await session.execute(query)
-        records = (result.scalars().all(),)
-        return records
+        paths = defaultdict(list)
+        for tweet_id, path, variants in result.all():
+            paths[tweet_id].append((variants or {}).get(size, path) if size else path)
+        return paths
+
+    @classmethod
+    def unreferenced(cls):
+        """Anti-join condition: no tweet references the attachment"""
+        return ~select(TweetAttachment.id).where(TweetAttachment.attachment_id == cls.model.id).exists()
+
+    @classmethod
+    @logger_decorator
+    async def delete_orphans(cls, session: AsyncSession, attachment_ids: List[int]):
+        """
+        Delete those of the given attachments that no tweet references and return their (id, path, blob_id) rows.
+        The reference check is repeated here, so a tweet created since the ids were picked keeps its media.
+        """
+        query = (
+            delete(cls.model)
+            .where(cls.model.id.in_(attachment_ids), cls.unreferenced())
+            .returning(cls.model.id, cls.model.path, cls.model.blob_id)
+        )
+        result = await session.execute(query)
+        return result.all()
+
+    @classmethod
+    @logger_decorator
+    async def set_variants(cls, session: AsyncSession, attachment_id: int, variants: dict):
+        query = (
+            update(cls.model)
+            .where(cls.model.id == attachment_id)
+            .values(variants=variants)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
+        # New versions of the tweets showing the attachment, so their cached fragments pick up the variants
+        query = (
+            update(Tweet)
+            .where(
+                Tweet.id.in_(select(TweetAttachment.tweet_id).where(TweetAttachment.attachment_id == attachment_id))
+            )
+            .values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(query)
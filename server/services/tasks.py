@@ -0,0 +1,29 @@
+"""Jobs run by the background worker, see services.jobs"""
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from logger_config import get_logger
+from services.jobs import job
+from services.media import process_attachment, remove_unreferenced_file
+from services.service import TimelineDAO, TweetDAO
+
+logger = get_logger("app_logger.jobs")
+
+
+@job("timeline.fan_out")
+async def fan_out_tweet(session: AsyncSession, tweet_id: int):
+    tweet = await TweetDAO.find_one_or_none(session, filters={"id": tweet_id})
+    if tweet is None:
+        logger.info("Tweet %s was deleted before its fan-out", tweet_id)
+        return
+    await TimelineDAO.fan_out(session, tweet)
+
+
+@job("media.process")
+async def process_media(session: AsyncSession, attachment_id: int, path: str):
+    await process_attachment(session, attachment_id, path)
+
+
+@job("media.remove_file")
+async def remove_file(session: AsyncSession, path: str):
+    await remove_unreferenced_file(session, path)
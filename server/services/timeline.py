@@ -0,0 +1,47 @@
+"""
+Backfill of the materialized home timelines (the timeline table) from the follows and tweets that existed
+before it, or that a lost fan-out job never wrote.
+
+    python -m services.counters    # first: who is fanned out on write depends on user.followers_count
+    python -m services.timeline
+
+Rows that are already there are kept, so it is safe to run again.
+"""
+
+import argparse
+import asyncio
+
+from sqlalchemy import func, select
+
+from database import AsyncSession as SessionFactory
+from logger_config import get_logger
+from models import User
+from services.service import TimelineDAO
+
+logger = get_logger("app_logger.services")
+
+# Users per transaction: each of them gets up to TIMELINE_BACKFILL_SIZE rows for every author they follow
+BATCH_SIZE = 100
+
+
+async def backfill_timelines(session_factory=SessionFactory, batch_size: int = BATCH_SIZE) -> int:
+    """Walk the users in id ranges of batch_size, one short transaction per range; return the rows written"""
+    async with session_factory() as session:
+        max_id = await session.scalar(select(func.max(User.id))) or 0
+
+    written = 0
+    for first_id in range(1, max_id + 1, batch_size):
+        async with session_factory() as session:
+            async with session.begin():
+                written += await TimelineDAO.backfill_range(session, first_id, first_id + batch_size - 1)
+
+    logger.info("Timelines backfilled with %s rows", written)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the materialized home timelines")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    print(asyncio.run(backfill_timelines(batch_size=args.batch_size)))
@@ -2,22 +2,20 @@ import os
 import sys
 from typing import AsyncGenerator
 
-
+import pytest
 import pytest_asyncio
 from fastapi.exceptions import HTTPException
 from httpx import ASGITransport, AsyncClient
-from sqlalchemy.ext.asyncio import (
-    async_sessionmaker,
-    create_async_engine,
-)
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
-from database import Base, get_session
+from database import Base, get_read_session, get_session
 from models import User
+from services import jobs
+from services.cache import caches
 
 from ..logger_config import get_logger
 from ..main import app as _app
 
-
 logger = get_logger("app_logger")
 
 test_db_url = os.getenv("DATABASE_TEST_URL")
@@ -57,6 +55,23 @@ async def setup_test_database():
     await engine.dispose()
 
 
+@pytest.fixture(scope="function", autouse=True)
+def clear_caches():
+    """
+    In-process caches outlive a single test, while the test database is recreated for every one of them
+    """
+    for cache in caches.values():
+        cache.clear()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def eager_jobs(monkeypatch):
+    """
+    The ASGI test client does not run the lifespan, so there is no job worker: jobs run inline instead
+    """
+    monkeypatch.setattr(jobs, "JOBS_EAGER", True)
+
+
 @pytest_asyncio.fixture(scope="function")
 async def db_session():
     """
@@ -90,6 +105,7 @@ async def async_client(db_session) -> AsyncGenerator[AsyncClient, None]:
         yield db_session
 
     _app.dependency_overrides[get_session] = override_get_session
+    _app.dependency_overrides[get_read_session] = override_get_session
 
     # Create the async client
     async with AsyncClient(transport=ASGITransport(app=_app), base_url="http://test") as ac:
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+from database import on_commit
+from services import cache as cache_module
+from services.cache import LRUCache, fragment_cache
+from services.feed import render_feed
+from services.service import LikeDAO, TweetDAO
+
+from .conftest import AsyncSession
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache("test_lru", maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    cache = LRUCache("test_ttl", maxsize=10, ttl=5)
+    cache.set("a", 1)
+    now[0] += 4
+    assert cache.get("a") == 1
+    now[0] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_lru_cache_skips_value_computed_before_clear():
+    cache = LRUCache("test_generation", maxsize=10)
+    generation = cache.generation
+    cache.clear()
+    cache.set("a", 1, generation=generation)
+    assert cache.get("a") is None
+
+
+def test_lru_cache_evicts_by_weight():
+    cache = LRUCache("test_weight", maxsize=10, maxweight=10, weigher=len)
+    cache.set("a", b"12345")
+    cache.set("b", b"1234")
+    cache.set("c", b"123")
+    assert cache.get("a") is None
+    assert cache.weight == 7
+
+    cache.set("b", b"1")
+    assert cache.weight == 4
+    cache.set("huge", b"x" * 11)
+    assert cache.get("huge") is None
+    cache.delete("c")
+    assert cache.weight == 1
+
+
+@pytest.mark.asyncio
+async def test_on_commit_runs_only_after_commit():
+    calls = []
+
+    async with AsyncSession() as session:
+        async with session.begin():
+            on_commit(session, lambda: calls.append("rolled back"))
+            await session.rollback()
+
+    async with AsyncSession() as session:
+        async with session.begin():
+            on_commit(session, lambda: calls.append("committed"))
+            assert calls == []
+
+    assert calls == ["committed"]
+
+
+@pytest.mark.asyncio
+async def test_get_all_tweets_served_from_cache(async_client_with_api_header):
+    first = await async_client_with_api_header.get("/api/tweets")
+    second = await async_client_with_api_header.get("/api/tweets")
+    assert first.json() == second.json()
+
+    response = await async_client_with_api_header.get("/api/cache/stats")
+    assert response.json()["caches"]["feed"]["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_feed_reuses_tweet_fragments():
+    async with AsyncSession() as session:
+        async with session.begin():
+            liked = await TweetDAO.add(session, content="liked", user_id=1)
+            untouched = await TweetDAO.add(session, content="untouched", user_id=1)
+
+    async with AsyncSession() as session:
+        page = json.loads(await render_feed(session, await TweetDAO.find_feed_refs(session, limit=10), None))
+        first = {tweet["id"]: tweet for tweet in page["tweets"]}
+
+    async with AsyncSession() as session:
+        async with session.begin():
+            await LikeDAO.add(session, user_id=2, tweet_id=liked.id)
+
+    hits = fragment_cache.hits
+    async with AsyncSession() as session:
+        page = json.loads(await render_feed(session, await TweetDAO.find_feed_refs(session, limit=10), None))
+        second = {tweet["id"]: tweet for tweet in page["tweets"]}
+
+    # The untouched tweet comes from its cached fragment, the liked one is rendered again
+    assert fragment_cache.hits == hits + 1
+    assert second[untouched.id] == first[untouched.id]
+    assert second[liked.id]["likes"] == [{"user_id": 2, "name": "David"}]
+    assert second[liked.id]["like_count"] == 1
@@ -0,0 +1,96 @@
+import io
+
+import pytest
+from PIL import Image
+
+from services.images import VARIANT_SIZES, make_variants, make_variants_in_pool, strip_metadata, variant_path
+
+
+def write_jpeg(path, size=(2000, 1000)):
+    exif = Image.Exif()
+    exif[0x010F] = "Secret Camera"  # Make
+    exif[0x0112] = 6  # Orientation: rotate 90 CW
+    Image.new("RGB", size, "red").save(path, format="JPEG", exif=exif)
+
+
+def test_make_variants_resizes_and_strips_metadata(tmp_path):
+    source = tmp_path / "photo.jpg"
+    write_jpeg(source)
+
+    variants = make_variants(str(source))
+
+    assert set(variants) == set(VARIANT_SIZES)
+    for name, max_side in VARIANT_SIZES.items():
+        with Image.open(variants[name]) as variant:
+            assert variant.format == "WEBP"
+            assert not variant.getexif()
+            # The orientation tag is applied to the pixels before it is dropped
+            assert variant.height > variant.width
+            assert max(variant.size) == (max_side or 2000)
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG", "WEBP"])
+def test_strip_metadata_rewrites_the_original(tmp_path, image_format):
+    source = tmp_path / "upload"
+    exif = Image.Exif()
+    exif[0x010F] = "Secret Camera"  # Make
+    Image.new("RGB", (200, 100), "red").save(source, format=image_format, exif=exif, comment=b"secret")
+
+    assert strip_metadata(str(source))
+
+    with Image.open(source) as stripped:
+        assert stripped.format == image_format
+        assert stripped.size == (200, 100)
+        assert not stripped.getexif()
+        assert "comment" not in stripped.info
+    assert list(tmp_path.iterdir()) == [source]
+
+
+def test_strip_metadata_applies_the_orientation(tmp_path):
+    source = tmp_path / "photo.jpg"
+    write_jpeg(source)
+
+    assert strip_metadata(str(source))
+
+    with Image.open(source) as stripped:
+        assert not stripped.getexif()
+        assert stripped.size == (1000, 2000)
+
+
+def test_strip_metadata_ignores_non_images(tmp_path):
+    source = tmp_path / "notes.txt"
+    source.write_bytes(b"not an image")
+
+    assert not strip_metadata(str(source))
+    assert source.read_bytes() == b"not an image"
+    assert list(tmp_path.iterdir()) == [source]
+
+
+def test_make_variants_ignores_non_images(tmp_path):
+    source = tmp_path / "notes.txt"
+    source.write_bytes(b"not an image")
+
+    assert make_variants(str(source)) == {}
+    assert list(tmp_path.iterdir()) == [source]
+
+
+def test_make_variants_reuses_existing_files(tmp_path):
+    source = tmp_path / "photo.png"
+    Image.new("RGB", (200, 100)).save(source)
+    first = make_variants(str(source))
+    mtimes = {name: (tmp_path / path).stat().st_mtime_ns for name, path in first.items()}
+
+    assert make_variants(str(source)) == first
+    assert {name: (tmp_path / path).stat().st_mtime_ns for name, path in first.items()} == mtimes
+
+
+@pytest.mark.asyncio
+async def test_make_variants_in_pool(tmp_path):
+    source = tmp_path / "photo.png"
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 300)).save(buffer, format="PNG")
+    source.write_bytes(buffer.getvalue())
+
+    variants = await make_variants_in_pool(str(source))
+
+    assert variants["thumb"] == variant_path(str(source), "thumb")
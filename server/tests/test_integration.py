@@ -1,8 +1,19 @@
+import hashlib
+import io
+import os
+from datetime import datetime, timedelta
+
 import pytest
+from fastapi import HTTPException, UploadFile
 from httpx import AsyncClient
-from sqlalchemy import insert, select
+from PIL import Image
+from sqlalchemy import func, insert, select
 
-from models import Attachment, Follower, Like, Tweet, User
+from models import Attachment, Blob, Follower, Like, Timeline, Tweet, TweetAttachment, User
+from services import gc, media, service, utils
+from services.cache import caches
+from services.counters import COUNTERS, repair_range
+from services.querystats import query_budget
 
 from ..logger_config import get_logger
 
@@ -259,3 +270,627 @@ async def test_unlike_tweet_success(async_client_with_api_header: AsyncClient, d
     like = await db_session.execute(select(Like).where(Like.tweet_id == tweet.id, Like.user_id == 1))
     assert like.scalars().first() is None
 
+
+@pytest.mark.asyncio
+async def test_get_all_tweets_batched_likes_and_attachments(async_client_with_api_header: AsyncClient, db_session):
+    result = await db_session.execute(
+        insert(Attachment).returning(Attachment.id), [{"path": "/media/a.png"}, {"path": "/media/b.png"}]
+    )
+    first_id, second_id = result.scalars().all()
+
+    result = await db_session.execute(
+        insert(Tweet).returning(Tweet.id),
+        [
+            {"content": "First", "user_id": 1, "attachments": [second_id, first_id]},
+            {"content": "Second", "user_id": 2},
+        ],
+    )
+    first_tweet_id, second_tweet_id = result.scalars().all()
+    await db_session.execute(
+        insert(Like),
+        [
+            {"user_id": 2, "tweet_id": first_tweet_id},
+            {"user_id": 3, "tweet_id": first_tweet_id},
+            {"user_id": 4, "tweet_id": second_tweet_id},
+        ],
+    )
+
+    response = await async_client_with_api_header.get("/api/tweets")
+    assert response.status_code == 200
+    tweets = {tweet["id"]: tweet for tweet in response.json()["tweets"]}
+    assert tweets[first_tweet_id]["attachments"] == ["/media/b.png", "/media/a.png"]
+    assert [like["name"] for like in tweets[first_tweet_id]["likes"]] == ["David", "Patric"]
+    assert tweets[second_tweet_id]["likes"] == [{"user_id": 4, "name": "Christian"}]
+    assert tweets[second_tweet_id]["attachments"] == []
+    assert tweets[second_tweet_id]["author"] == {"id": 2, "name": "David"}
+
+
+@pytest.mark.asyncio
+async def test_get_all_tweets_keyset_pagination(async_client_with_api_header: AsyncClient, db_session):
+    await db_session.execute(insert(Tweet), [{"content": f"Tweet {i}", "user_id": 1} for i in range(5)])
+
+    seen = []
+    response = await async_client_with_api_header.get("/api/tweets", params={"limit": 2})
+    data = response.json()
+    while True:
+        assert response.status_code == 200
+        assert len(data["tweets"]) <= 2
+        seen.extend(tweet["id"] for tweet in data["tweets"])
+        if data["next_cursor"] is None:
+            break
+        response = await async_client_with_api_header.get(
+            "/api/tweets", params={"limit": 2, "before": data["next_cursor"]}
+        )
+        data = response.json()
+
+    assert len(seen) == 5
+    assert seen == sorted(seen, reverse=True)
+
+
+@pytest.mark.asyncio
+async def test_get_all_tweets_invalid_cursor(async_client_with_api_header: AsyncClient):
+    response = await async_client_with_api_header.get("/api/tweets", params={"before": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_timeline_fan_out_on_write(async_client_with_api_header: AsyncClient, db_session):
+    await async_client_with_api_header.post("/api/users/2/follow")
+    response = await async_client_with_api_header.post(
+        "/api/tweets", json={"tweet_data": "Followed tweet", "tweet_media_ids": []}, headers={"Api-Key": "david"}
+    )
+    tweet_id = response.json()["tweet_id"]
+    await async_client_with_api_header.post(
+        "/api/tweets", json={"tweet_data": "Stranger tweet", "tweet_media_ids": []}, headers={"Api-Key": "patric"}
+    )
+
+    rows = await db_session.execute(select(Timeline.tweet_id).where(Timeline.user_id == 1))
+    assert rows.scalars().all() == [tweet_id]
+
+    response = await async_client_with_api_header.get("/api/timeline")
+    assert response.status_code == 200
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [tweet_id]
+
+    await async_client_with_api_header.delete("/api/users/2/follow")
+    response = await async_client_with_api_header.get("/api/timeline")
+    assert response.json()["tweets"] == []
+
+
+@pytest.mark.asyncio
+async def test_timeline_fan_out_on_read_for_popular_author(
+    async_client_with_api_header: AsyncClient, db_session, monkeypatch
+):
+    monkeypatch.setattr(service, "TIMELINE_FANOUT_LIMIT", 0)
+    await async_client_with_api_header.post("/api/users/2/follow")
+    response = await async_client_with_api_header.post(
+        "/api/tweets", json={"tweet_data": "Popular tweet", "tweet_media_ids": []}, headers={"Api-Key": "david"}
+    )
+    tweet_id = response.json()["tweet_id"]
+
+    rows = await db_session.execute(select(Timeline).where(Timeline.user_id == 1))
+    assert rows.scalars().all() == []
+
+    response = await async_client_with_api_header.get("/api/timeline")
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [tweet_id]
+
+
+@pytest.mark.asyncio
+async def test_get_users_me_resolves_api_key_from_cache(async_client_with_api_header: AsyncClient):
+    await async_client_with_api_header.get("/api/users/me")
+    response = await async_client_with_api_header.get("/api/users/me")
+    assert response.status_code == 200
+    assert response.json()["user"]["name"] == "test"
+
+    stats = (await async_client_with_api_header.get("/api/cache/stats")).json()["caches"]["auth"]
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_users_me_invalid_api_key(async_client: AsyncClient):
+    response = await async_client.get("/api/users/me", headers={"Api-Key": "unknown"})
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Invalid API Key"
+
+
+@pytest.mark.asyncio
+async def test_like_and_follow_maintain_counters(async_client_with_api_header: AsyncClient, db_session):
+    result = await db_session.execute(insert(Tweet).values(content="Counted", user_id=2).returning(Tweet.id))
+    tweet_id = result.scalar_one()
+
+    await async_client_with_api_header.post(f"/api/tweets/{tweet_id}/likes")
+    await async_client_with_api_header.post("/api/users/2/follow")
+
+    tweets = (await async_client_with_api_header.get("/api/tweets")).json()["tweets"]
+    assert tweets[0]["like_count"] == 1
+
+    me = (await async_client_with_api_header.get("/api/users/me")).json()["user"]
+    assert me["following_count"] == 1
+    assert me["followers_count"] == 0
+    david = (await async_client_with_api_header.get("/api/users/2")).json()["user"]
+    assert david["followers_count"] == 1
+
+    await async_client_with_api_header.delete(f"/api/tweets/{tweet_id}/likes")
+    like_count = await db_session.scalar(select(Tweet.like_count).where(Tweet.id == tweet_id))
+    assert like_count == 0
+
+
+@pytest.mark.asyncio
+async def test_timeline_backfill_materializes_existing_follows(db_session):
+    await db_session.execute(insert(Follower).values(user_id=1, followed_user_id=2))
+    result = await db_session.execute(
+        insert(Tweet).returning(Tweet.id, sort_by_parameter_order=True),
+        [{"content": "Mine", "user_id": 1}, {"content": "Followed", "user_id": 2}, {"content": "Other", "user_id": 3}],
+    )
+    own, followed, _ = result.scalars().all()
+
+    assert await service.TimelineDAO.backfill_range(db_session, 1, 100) == 4
+    refs = await service.TimelineDAO.find_tweet_refs(db_session, user_id=1, limit=10)
+    assert sorted(ref.id for ref in refs) == [own, followed]
+    # Rows that are already there are kept
+    assert await service.TimelineDAO.backfill_range(db_session, 1, 100) == 0
+
+
+@pytest.mark.asyncio
+async def test_repair_counters_fixes_drift(db_session):
+    result = await db_session.execute(insert(Tweet).values(content="Drifted", user_id=1).returning(Tweet.id))
+    tweet_id = result.scalar_one()
+    # Rows written behind the DAOs' back leave the counters stale
+    await db_session.execute(
+        insert(Like), [{"user_id": 2, "tweet_id": tweet_id}, {"user_id": 3, "tweet_id": tweet_id}]
+    )
+    await db_session.execute(insert(Follower).values(user_id=2, followed_user_id=1))
+
+    for column, actual in COUNTERS.values():
+        assert await repair_range(db_session, column, actual, 1, 1000, dry_run=True) >= 1
+        await repair_range(db_session, column, actual, 1, 1000)
+        assert await repair_range(db_session, column, actual, 1, 1000, dry_run=True) == 0
+
+    assert await db_session.scalar(select(Tweet.like_count).where(Tweet.id == tweet_id)) == 2
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 1)) == 1
+    assert await db_session.scalar(select(User.following_count).where(User.id == 2)) == 1
+
+
+@pytest.mark.asyncio
+async def test_search_tweets_ranked_and_highlighted(async_client_with_api_header: AsyncClient, db_session):
+    await db_session.execute(
+        insert(Tweet),
+        [
+            {"content": "Моя кошка спит весь день", "user_id": 1},
+            {"content": "Кошки любят молоко, а кошка Мурка любит сметану", "user_id": 2},
+            {"content": "Собака лает на почтальона", "user_id": 3},
+        ],
+    )
+
+    response = await async_client_with_api_header.get("/api/tweets/search", params={"q": "кошка", "limit": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["tweets"]) == 1
+    first = data["tweets"][0]
+    assert first["content"].startswith("Кошки любят")
+    assert "<b>" in first["highlight"]
+
+    response = await async_client_with_api_header.get(
+        "/api/tweets/search", params={"q": "кошка", "limit": 1, "before": data["next_cursor"]}
+    )
+    data = response.json()
+    assert [tweet["content"] for tweet in data["tweets"]] == ["Моя кошка спит весь день"]
+    assert data["tweets"][0]["rank"] <= first["rank"]
+    assert data["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_search_highlight_escapes_tweet_markup(async_client_with_api_header: AsyncClient, db_session):
+    await db_session.execute(insert(Tweet).values(content='<img src=x onerror="alert(1)"> кошка \x02', user_id=2))
+
+    response = await async_client_with_api_header.get("/api/tweets/search", params={"q": "кошка"})
+    [tweet] = response.json()["tweets"]
+    assert "<img" not in tweet["highlight"] and "&lt;img" in tweet["highlight"]
+    assert "<b>кошка</b>" in tweet["highlight"]
+    assert tweet["highlight"].count("<b>") == 1
+
+
+def test_highlight_html_marks_only_matches():
+    assert service.highlight_html('a <i>&</i> "\x02cat\x03"') == "a &lt;i&gt;&amp;&lt;/i&gt; &quot;<b>cat</b>&quot;"
+
+
+@pytest.mark.asyncio
+async def test_search_tweets_requires_query(async_client_with_api_header: AsyncClient):
+    response = await async_client_with_api_header.get("/api/tweets/search")
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_upload_media_streams_to_disk(
+    async_client_with_api_header: AsyncClient, db_session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    content = b"0123456789" * 1000
+
+    response = await async_client_with_api_header.post("/api/medias", files={"file": ("image.png", content)})
+    assert response.status_code == 201
+    media_id = response.json()["media_id"]
+
+    path = await db_session.scalar(select(Attachment.path).where(Attachment.id == media_id))
+    assert open(path, "rb").read() == content
+
+
+@pytest.mark.asyncio
+async def test_upload_media_rejects_too_large_file(async_client_with_api_header: AsyncClient, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    monkeypatch.setattr(utils, "MEDIA_MAX_SIZE", 1024)
+    monkeypatch.setattr(utils, "MEDIA_CHUNK_SIZE", 256)
+
+    response = await async_client_with_api_header.post("/api/medias", files={"file": ("big.bin", b"x" * 4096)})
+    assert response.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_upload_request_body_is_limited_before_parsing(async_client_with_api_header: AsyncClient, monkeypatch):
+    monkeypatch.setattr(utils, "MEDIA_MAX_SIZE", 1024)
+    monkeypatch.setattr(utils, "MEDIA_FORM_OVERHEAD", 0)
+    spooled = []
+    monkeypatch.setattr(utils.FileHandleService, "save", lambda self: spooled.append(self))
+
+    # Declared size: refused from the headers alone
+    response = await async_client_with_api_header.post("/api/medias", files={"file": ("big.bin", b"x" * 4096)})
+    assert response.status_code == 413
+    assert response.json()["detail"]["result"] is False
+
+    # Chunked body without Content-Length: refused once more than the limit has been streamed in
+    async def chunks():
+        yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="big.bin"\r\n\r\n'
+        for _ in range(8):
+            yield b"x" * 512
+
+    response = await async_client_with_api_header.post(
+        "/api/medias", content=chunks(), headers={"Content-Type": "multipart/form-data; boundary=b"}
+    )
+    assert response.status_code == 413
+    assert spooled == []
+
+
+@pytest.mark.asyncio
+async def test_file_handle_service_aborts_mid_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    # No declared size: the limit can only be enforced while streaming
+    upload = UploadFile(file=io.BytesIO(b"x" * 4096), filename="big.bin")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await utils.FileHandleService(upload, chunk_size=256, max_size=1024).save()
+
+    assert exc_info.value.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_file_handle_service_hashes_while_copying(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    content = b"hello media" * 100
+    fileservice = utils.FileHandleService(UploadFile(file=io.BytesIO(content), filename="a.txt"), chunk_size=64)
+
+    _, path = await fileservice.save()
+
+    assert fileservice.sha256 == hashlib.sha256(content).hexdigest()
+    assert fileservice.size == len(content)
+    assert open(path, "rb").read() == content
+
+
+@pytest.mark.asyncio
+async def test_upload_media_deduplicates_identical_files(
+    async_client_with_api_header: AsyncClient, db_session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    content = b"the same meme"
+
+    first = await async_client_with_api_header.post("/api/medias", files={"file": ("meme.png", content)})
+    second = await async_client_with_api_header.post("/api/medias", files={"file": ("copy.PNG", content)})
+    media_ids = [first.json()["media_id"], second.json()["media_id"]]
+    assert media_ids[0] != media_ids[1]
+
+    result = await db_session.execute(select(Attachment).where(Attachment.id.in_(media_ids)))
+    attachments = result.scalars().all()
+    assert len({attachment.path for attachment in attachments}) == 1
+    [stored] = tmp_path.iterdir()
+    assert stored.name.startswith(hashlib.sha256(content).hexdigest()) and stored.suffix == ".png"
+
+    blob = await db_session.scalar(select(Blob).where(Blob.id == attachments[0].blob_id))
+    assert blob.ref_count == 2
+
+    await service.AttachmentDAO.delete(db_session, id=media_ids[0])
+    assert await db_session.scalar(select(Blob.ref_count).where(Blob.id == blob.id)) == 1
+    await service.AttachmentDAO.delete(db_session, id=media_ids[1])
+    assert await db_session.scalar(select(Blob).where(Blob.id == blob.id)) is None
+
+
+@pytest.mark.asyncio
+async def test_upload_image_records_variants_for_feed(
+    async_client_with_api_header: AsyncClient, db_session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    buffer = io.BytesIO()
+    Image.new("RGB", (1600, 1200), "blue").save(buffer, format="PNG")
+
+    response = await async_client_with_api_header.post("/api/medias", files={"file": ("photo.png", buffer.getvalue())})
+    media_id = response.json()["media_id"]
+    attachment = await db_session.scalar(select(Attachment).where(Attachment.id == media_id))
+    assert set(attachment.variants) == {"thumb", "small", "medium", "full"}
+
+    payload = {"tweet_data": "Tweet with a photo", "tweet_media_ids": [media_id]}
+    await async_client_with_api_header.post("/api/tweets", json=payload)
+
+    response = await async_client_with_api_header.get("/api/tweets", params={"media_size": "thumb"})
+    assert response.json()["tweets"][0]["attachments"] == [attachment.variants["thumb"]]
+    response = await async_client_with_api_header.get("/api/tweets")
+    assert response.json()["tweets"][0]["attachments"] == [attachment.path]
+
+
+@pytest.mark.asyncio
+async def test_upload_image_strips_metadata_from_the_original(
+    async_client_with_api_header: AsyncClient, db_session, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(utils, "MEDIA_DIR", tmp_path)
+    exif = Image.Exif()
+    exif[0x010F] = "Secret Camera"  # Make
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), "green").save(buffer, format="JPEG", exif=exif)
+    content = buffer.getvalue()
+
+    response = await async_client_with_api_header.post("/api/medias", files={"file": ("photo.jpg", content)})
+    attachment = await db_session.scalar(select(Attachment).where(Attachment.id == response.json()["media_id"]))
+
+    with Image.open(attachment.path) as original:
+        assert not original.getexif()
+    blob = await db_session.scalar(select(Blob).where(Blob.id == attachment.blob_id))
+    assert blob.sha256 == hashlib.sha256(content).hexdigest()
+    assert blob.size == os.path.getsize(attachment.path)
+
+
+@pytest.mark.asyncio
+async def test_media_gc_collects_only_orphans(db_session, tmp_path):
+    old = datetime(2020, 1, 1)
+    files = {name: tmp_path / name for name in ("kept.png", "shared.png", "legacy.png", "fresh.png")}
+    for path in files.values():
+        path.write_bytes(b"x" * 10)
+
+    result = await db_session.execute(
+        insert(Blob).returning(Blob.id),
+        [
+            {"sha256": "a" * 64, "path": str(files["kept.png"]), "size": 10, "ref_count": 1},
+            {"sha256": "b" * 64, "path": str(files["shared.png"]), "size": 10, "ref_count": 2},
+        ],
+    )
+    kept_blob, shared_blob = result.scalars().all()
+    result = await db_session.execute(
+        insert(Attachment).returning(Attachment.id),
+        [
+            {"path": str(files["kept.png"]), "blob_id": kept_blob, "created_at": old},
+            {"path": str(files["shared.png"]), "blob_id": shared_blob, "created_at": old},
+            {"path": str(files["shared.png"]), "blob_id": shared_blob, "created_at": old},
+            {"path": str(files["legacy.png"]), "created_at": old},
+            # Still within the grace period: may be attached to a tweet any moment
+            {"path": str(files["fresh.png"])},
+        ],
+    )
+    kept, shared_1, shared_2, legacy, fresh = result.scalars().all()
+    await db_session.execute(insert(Tweet).values(content="With media", user_id=1, attachments=[kept]))
+
+    dry_run = await gc.collect_batch(db_session, 0, 100, timedelta(hours=1), dry_run=True)
+    assert dry_run == (fresh - 1, 3, 20, [str(files["legacy.png"])])
+
+    last_id, deleted, reclaimed, paths = await gc.collect_batch(db_session, 0, 100, timedelta(hours=1))
+    assert (last_id, deleted, reclaimed) == (fresh - 1, 3, 20)
+    assert sorted(paths) == sorted([str(files["legacy.png"]), str(files["shared.png"])])
+
+    remaining = await db_session.scalars(select(Attachment.id).order_by(Attachment.id))
+    assert remaining.all() == [kept, fresh]
+    assert await db_session.scalar(select(Blob.id).where(Blob.id == shared_blob)) is None
+    assert await gc.collect_batch(db_session, last_id, 100, timedelta(hours=1)) == (None, 0, 0, [])
+
+
+@pytest.mark.asyncio
+async def test_late_file_removal_keeps_a_reuploaded_blob(db_session, tmp_path):
+    sha256 = "c" * 64
+    old, new = tmp_path / f"{sha256}-old.png", tmp_path / f"{sha256}-new.png"
+    old.write_bytes(b"x")
+    new.write_bytes(b"x")
+    # The same bytes were uploaded again after the old blob was released
+    await db_session.execute(insert(Blob).values(sha256=sha256, path=str(new), size=1, ref_count=1))
+
+    assert await media.remove_unreferenced_file(db_session, str(old))
+    assert not await media.remove_unreferenced_file(db_session, str(new))
+    assert [path.name for path in tmp_path.iterdir()] == [new.name]
+
+
+def test_media_gc_removes_stale_partial_uploads(tmp_path):
+    stale, fresh = tmp_path / "stale.part", tmp_path / "fresh.part"
+    stale.write_bytes(b"x" * 100)
+    fresh.write_bytes(b"x" * 100)
+    os.utime(stale, (0, 0))
+
+    assert gc.remove_stale_uploads(tmp_path, timedelta(hours=1)) == (1, 100)
+    assert [path.name for path in tmp_path.iterdir()] == ["fresh.part"]
+
+
+@pytest.mark.asyncio
+async def test_tweet_attachments_are_mirrored_into_join_table(async_client_with_api_header: AsyncClient, db_session):
+    result = await db_session.execute(
+        insert(Attachment).returning(Attachment.id), [{"path": "/media/first.png"}, {"path": "/media/second.png"}]
+    )
+    first, second = result.scalars().all()
+
+    # Ids without an attachment row are ignored, the posting order is kept
+    payload = {"tweet_data": "Two pictures", "tweet_media_ids": [second, 10_000, first]}
+    response = await async_client_with_api_header.post("/api/tweets", json=payload)
+    tweet_id = response.json()["tweet_id"]
+
+    links = await db_session.execute(
+        select(TweetAttachment.attachment_id, TweetAttachment.position).where(TweetAttachment.tweet_id == tweet_id)
+    )
+    assert sorted(links.all(), key=lambda link: link.position) == [(second, 0), (first, 2)]
+
+    response = await async_client_with_api_header.get("/api/tweets")
+    assert response.json()["tweets"][0]["attachments"] == ["/media/second.png", "/media/first.png"]
+
+    await async_client_with_api_header.delete(f"/api/tweets/{tweet_id}")
+    assert await db_session.scalar(select(func.count(TweetAttachment.id))) == 0
+    assert await db_session.scalar(select(func.count(Attachment.id))) == 2
+
+
+@pytest.mark.asyncio
+async def test_feed_conditional_get(async_client_with_api_header: AsyncClient):
+    await async_client_with_api_header.post("/api/tweets", json={"tweet_data": "First", "tweet_media_ids": []})
+    response = await async_client_with_api_header.get("/api/tweets")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"].startswith("public")
+
+    response = await async_client_with_api_header.get("/api/tweets", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    await async_client_with_api_header.post("/api/tweets", json={"tweet_data": "Second", "tweet_media_ids": []})
+    caches["feed"].clear()
+    response = await async_client_with_api_header.get("/api/tweets", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_profile_conditional_get(async_client_with_api_header: AsyncClient):
+    response = await async_client_with_api_header.get("/api/users/me")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+    assert response.headers["vary"] == "Api-Key"
+
+    response = await async_client_with_api_header.get("/api/users/me", headers={"If-None-Match": f'W/{etag}, "x"'})
+    assert response.status_code == 304
+    assert response.headers["vary"] == "Api-Key"
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    # Following somebody changes the follower's profile and the followed one's
+    other = await async_client_with_api_header.get("/api/users/2")
+    await async_client_with_api_header.post("/api/users/2/follow")
+    response = await async_client_with_api_header.get("/api/users/me", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    response = await async_client_with_api_header.get("/api/users/2", headers={"If-None-Match": other.headers["etag"]})
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("tweet_count", [1, 25])
+async def test_get_all_tweets_query_budget(async_client_with_api_header: AsyncClient, db_session, tweet_count):
+    result = await db_session.execute(
+        insert(Attachment).returning(Attachment.id), [{"path": f"/media/{i}.png"} for i in range(tweet_count)]
+    )
+    result = await db_session.execute(
+        insert(Tweet).returning(Tweet.id),
+        [
+            {"content": f"Tweet {i}", "user_id": 1 + i % 4, "attachments": [attachment_id]}
+            for i, attachment_id in enumerate(result.scalars().all())
+        ],
+    )
+    await db_session.execute(
+        insert(Like),
+        [{"user_id": user_id, "tweet_id": tweet_id} for tweet_id in result.scalars().all() for user_id in (2, 3)],
+    )
+
+    # Page ids, tweet rows, likers and attachment paths: one query each, however long the page
+    with query_budget(4) as stats:
+        response = await async_client_with_api_header.get("/api/tweets")
+    assert response.status_code == 200
+    assert len(response.json()["tweets"]) == tweet_count
+    assert not stats.repeated()
+
+
+@pytest.mark.asyncio
+async def test_batch_likes_report_every_tweet(async_client_with_api_header: AsyncClient, db_session):
+    result = await db_session.execute(
+        insert(Tweet).returning(Tweet.id, sort_by_parameter_order=True),
+        [{"content": "First", "user_id": 2}, {"content": "Second", "user_id": 3}],
+    )
+    first, second = result.scalars().all()
+    await db_session.execute(insert(Like).values(user_id=1, tweet_id=first))
+
+    response = await async_client_with_api_header.post(
+        "/api/likes", params={"tweet_ids": [first, second, second, 999]}
+    )
+    assert response.status_code == 200
+    assert response.json()["items"] == [
+        {"id": first, "status": "exists"},
+        {"id": second, "status": "created"},
+        {"id": 999, "status": "not_found"},
+    ]
+    assert await db_session.scalar(select(Tweet.like_count).where(Tweet.id == second)) == 1
+
+    response = await async_client_with_api_header.delete("/api/likes", params={"tweet_ids": [first, second, 999]})
+    assert [item["status"] for item in response.json()["items"]] == ["deleted", "deleted", "not_found"]
+    assert await db_session.scalar(select(func.count()).select_from(Like)) == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_follows_maintain_counters(async_client_with_api_header: AsyncClient, db_session):
+    await db_session.execute(insert(Tweet).values(content="Backfilled", user_id=3))
+
+    response = await async_client_with_api_header.post("/api/follows", params={"user_ids": [1, 2, 3, 999]})
+    assert [item["status"] for item in response.json()["items"]] == ["invalid", "created", "created", "not_found"]
+    me = (await async_client_with_api_header.get("/api/users/me")).json()["user"]
+    assert me["following_count"] == 2
+    assert await db_session.scalar(select(func.count()).select_from(Timeline).where(Timeline.user_id == 1)) == 1
+
+    response = await async_client_with_api_header.post("/api/follows", params={"user_ids": [2]})
+    assert response.json()["items"] == [{"id": 2, "status": "exists"}]
+
+    response = await async_client_with_api_header.delete("/api/follows", params={"user_ids": [2, 3, 4]})
+    assert [item["status"] for item in response.json()["items"]] == ["deleted", "deleted", "not_found"]
+    assert await db_session.scalar(select(User.following_count).where(User.id == 1)) == 0
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 3)) == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_limits_and_media_check(async_client_with_api_header: AsyncClient, db_session):
+    media_id = (await db_session.execute(insert(Attachment).values(path="a.jpg").returning(Attachment.id))).scalar()
+
+    response = await async_client_with_api_header.get("/api/medias", params={"ids": [media_id, media_id + 1]})
+    assert response.json()["items"] == [
+        {"id": media_id, "status": "found"},
+        {"id": media_id + 1, "status": "not_found"},
+    ]
+
+    response = await async_client_with_api_header.post("/api/likes", params={"tweet_ids": list(range(101))})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_like_and_follow_retries_are_no_ops(async_client_with_api_header: AsyncClient, db_session):
+    result = await db_session.execute(insert(Tweet).values(content="Retried", user_id=2).returning(Tweet.id))
+    tweet_id = result.scalar_one()
+
+    for _ in range(2):
+        assert (await async_client_with_api_header.post(f"/api/tweets/{tweet_id}/likes")).status_code == 201
+        assert (await async_client_with_api_header.post("/api/users/2/follow")).status_code == 201
+    assert await db_session.scalar(select(Tweet.like_count).where(Tweet.id == tweet_id)) == 1
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 2)) == 1
+
+    for _ in range(2):
+        assert (await async_client_with_api_header.delete(f"/api/tweets/{tweet_id}/likes")).status_code == 200
+        assert (await async_client_with_api_header.delete("/api/users/2/follow")).status_code == 200
+    assert await db_session.scalar(select(Tweet.like_count).where(Tweet.id == tweet_id)) == 0
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 2)) == 0
+
+
+@pytest.mark.asyncio
+async def test_like_and_follow_dao_base_methods_are_idempotent(db_session):
+    result = await db_session.execute(insert(Tweet).values(content="Liked twice", user_id=2).returning(Tweet.id))
+    tweet_id = result.scalar_one()
+
+    assert await service.LikeDAO.add(db_session, user_id=1, tweet_id=tweet_id) is not None
+    assert await service.LikeDAO.add(db_session, user_id=1, tweet_id=tweet_id) is None
+    await service.FollowerDAO.add_many(db_session, [{"user_id": 1, "followed_user_id": 2}] * 2)
+    assert await db_session.scalar(select(Tweet.like_count).where(Tweet.id == tweet_id)) == 1
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 2)) == 1
+
+    assert await service.FollowerDAO.delete(db_session, user_id=1, followed_user_id=2) is not None
+    assert await service.FollowerDAO.delete(db_session, user_id=1, followed_user_id=2) is None
+    assert await db_session.scalar(select(User.followers_count).where(User.id == 2)) == 0
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from services import jobs
+
+from .conftest import AsyncSession
+
+calls = []
+
+
+@jobs.job("test.record")
+async def record(session, value):
+    calls.append(value)
+
+
+@jobs.job("test.flaky", max_retries=2)
+async def flaky(session, fail_times):
+    calls.append("attempt")
+    if len(calls) <= fail_times:
+        raise RuntimeError("boom")
+
+
+@jobs.job("test.slow")
+async def slow(session):
+    calls.append("start")
+    await asyncio.sleep(0.05)
+    calls.append("end")
+
+
+@pytest_asyncio.fixture
+async def worker(monkeypatch):
+    calls.clear()
+    monkeypatch.setattr(jobs, "JOBS_EAGER", False)
+    await jobs.start(broker=jobs.LocalBroker(":memory:", poll_interval=0.01), session_factory=AsyncSession)
+    jobs.worker.retry_delay = 0.01
+    yield jobs.worker
+    await jobs.stop()
+
+
+async def wait_until_settled(worker, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while worker.broker.pending() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_job_is_published_on_commit(worker):
+    async with AsyncSession() as session:
+        async with session.begin():
+            await jobs.enqueue(session, "test.record", value=1)
+            await asyncio.sleep(0.05)
+            assert calls == []
+
+    await asyncio.sleep(0)
+    await wait_until_settled(worker)
+    assert calls == [1]
+
+
+@pytest.mark.asyncio
+async def test_job_is_dropped_on_rollback(worker):
+    async with AsyncSession() as session:
+        await session.begin()
+        await jobs.enqueue(session, "test.record", value=1)
+        await session.rollback()
+
+    await asyncio.sleep(0.05)
+    assert calls == []
+    assert worker.broker.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_job_is_retried(worker):
+    await worker.broker.publish({"id": "1", "name": "test.flaky", "kwargs": {"fail_times": 1}, "attempt": 0})
+    await wait_until_settled(worker)
+
+    assert calls == ["attempt", "attempt"]
+    assert worker.broker.dead_letters() == []
+
+
+@pytest.mark.asyncio
+async def test_exhausted_job_is_dead_lettered(worker):
+    await worker.broker.publish({"id": "1", "name": "test.flaky", "kwargs": {"fail_times": 10}, "attempt": 0})
+    await wait_until_settled(worker)
+
+    assert calls == ["attempt"] * 3
+    [dead] = worker.broker.dead_letters()
+    assert dead["attempt"] == 3
+    assert dead["error"] == "RuntimeError: boom"
+
+
+@pytest.mark.asyncio
+async def test_unknown_job_is_dead_lettered(worker):
+    await worker.broker.publish({"id": "1", "name": "test.missing", "kwargs": {}, "attempt": 0})
+    await wait_until_settled(worker)
+
+    assert worker.broker.dead_letters()[0]["error"] == "Unknown job test.missing"
+
+
+@pytest.mark.asyncio
+async def test_worker_bounds_concurrency(monkeypatch):
+    calls.clear()
+    worker = jobs.JobWorker(
+        jobs.LocalBroker(":memory:", poll_interval=0.01), session_factory=AsyncSession, concurrency=1
+    )
+    await worker.start()
+    for index in range(2):
+        await worker.broker.publish({"id": str(index), "name": "test.slow", "kwargs": {}, "attempt": 0})
+    await wait_until_settled(worker)
+    await worker.stop()
+
+    assert calls == ["start", "end", "start", "end"]
+
+
+@pytest.mark.asyncio
+async def test_local_broker_keeps_pending_jobs_across_restarts(tmp_path):
+    path = str(tmp_path / "jobs" / "jobs.db")
+    broker = jobs.LocalBroker(path)
+    await broker.start()
+    await broker.publish({"id": "1", "name": "test.record", "kwargs": {"value": 1}, "attempt": 0})
+    await broker.close()
+
+    broker = jobs.LocalBroker(path)
+    await broker.start()
+    assert broker.pending() == 1
+    assert (await broker.get())["kwargs"] == {"value": 1}
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_publish_is_logged(worker, monkeypatch):
+    errors = []
+    monkeypatch.setattr(jobs.logger, "error", lambda msg, *args: errors.append(msg % args))
+
+    async def publish(message, delay=0.0):
+        raise ConnectionError("broker down")
+
+    monkeypatch.setattr(worker.broker, "publish", publish)
+    async with AsyncSession() as session:
+        async with session.begin():
+            await jobs.enqueue(session, "test.record", value=1)
+    await asyncio.sleep(0.05)
+
+    [error] = errors
+    assert "dropped: publishing failed" in error and "broker down" in error
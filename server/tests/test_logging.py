@@ -0,0 +1,60 @@
+import json
+import logging
+import threading
+
+from logger_config import JSONFormatter, QueueListenerHandler, SamplingFilter
+
+
+class ThreadRecorder:
+    """Remember which thread rendered it"""
+
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return "rendered"
+
+
+def make_record(level=logging.INFO, msg="%s done", args=("job",), **extra):
+    record = logging.LogRecord("app_logger.test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_puts_extra_fields_at_top_level():
+    data = json.loads(JSONFormatter().format(make_record(status_code=201, duration=0.25)))
+
+    assert data["message"] == "job done"
+    assert data["level"] == "INFO"
+    assert data["logger"] == "app_logger.test"
+    assert data["status_code"] == 201
+    assert data["duration"] == 0.25
+    assert "args" not in data and "exc_info" not in data
+
+
+def test_sampling_filter_never_drops_warnings():
+    sampling = SamplingFilter(rate=0.0)
+
+    assert not sampling.filter(make_record(logging.INFO))
+    assert sampling.filter(make_record(logging.WARNING))
+    assert SamplingFilter(rate=1.0).filter(make_record(logging.DEBUG))
+
+
+def test_queue_handler_formats_on_the_listener_thread():
+    records = []
+    target = logging.Handler()
+    target.emit = lambda record: records.append(record.getMessage())
+    handler = QueueListenerHandler([target])
+    logger = logging.getLogger("app_logger.test.queue")
+    logger.addHandler(handler)
+    logger.propagate = False
+    value = ThreadRecorder()
+    try:
+        logger.warning("value %s", value)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    assert records == ["value rendered"]
+    assert value.thread is not threading.current_thread()
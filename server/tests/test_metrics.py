@@ -0,0 +1,78 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+from prometheus_client import REGISTRY
+
+from main import app
+from services.utils import logger_decorator
+
+
+class SampleDAO:
+    @classmethod
+    @logger_decorator
+    async def find(cls, fail: bool = False):
+        if fail:
+            raise LookupError("nothing")
+        return 1
+
+
+class ChildDAO(SampleDAO):
+    @classmethod
+    @logger_decorator
+    async def find(cls, fail: bool = False):
+        return await super().find(fail=fail)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_dao_calls_are_timed_and_errors_counted():
+    calls = sample("dao_call_duration_seconds_count", dao="SampleDAO", method="find")
+    errors = sample("dao_call_errors_total", dao="SampleDAO", method="find", error="LookupError")
+
+    assert await SampleDAO.find() == 1
+    with pytest.raises(LookupError):
+        await SampleDAO.find(fail=True)
+
+    assert sample("dao_call_duration_seconds_count", dao="SampleDAO", method="find") == calls + 2
+    assert sample("dao_call_errors_total", dao="SampleDAO", method="find", error="LookupError") == errors + 1
+
+
+@pytest.mark.asyncio
+async def test_override_calling_super_is_measured_once():
+    calls = sample("dao_call_duration_seconds_count", dao="ChildDAO", method="find")
+    errors = sample("dao_call_errors_total", dao="ChildDAO", method="find", error="LookupError")
+
+    assert await ChildDAO.find() == 1
+    assert sample("dao_call_duration_seconds_count", dao="ChildDAO", method="find") == calls + 1
+    with pytest.raises(LookupError):
+        await ChildDAO.find(fail=True)
+
+    assert sample("dao_call_duration_seconds_count", dao="ChildDAO", method="find") == calls + 2
+    assert sample("dao_call_errors_total", dao="ChildDAO", method="find", error="LookupError") == errors + 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_labelled_by_route_template():
+    unmatched = sample("http_request_duration_seconds_count", method="GET", route="unmatched", status="404")
+    templated = sample(
+        "http_request_duration_seconds_count", method="DELETE", route="/api/tweets/{tweet_id}", status="401"
+    )
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        assert (await client.get("/api/no/such/route")).status_code == 404
+        assert (await client.delete("/api/tweets/7")).status_code == 401
+        response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert (
+        sample("http_request_duration_seconds_count", method="GET", route="unmatched", status="404") == unmatched + 1
+    )
+    assert (
+        sample("http_request_duration_seconds_count", method="DELETE", route="/api/tweets/{tweet_id}", status="401")
+        == templated + 1
+    )
+    assert 'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}' in response.text
+    assert 'http_requests_in_flight{method="GET"} 1.0' in response.text
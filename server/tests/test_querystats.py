@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import bindparam, create_engine, text
+
+from services.querystats import QueryBudgetExceeded, query_budget, statement_shape, track_queries
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE item (id INTEGER PRIMARY KEY)"))
+        conn.execute(text("INSERT INTO item (id) VALUES (1), (2), (3)"))
+        yield conn
+    engine.dispose()
+
+
+def test_repeated_lookups_share_one_shape(connection):
+    lookup = text("SELECT id FROM item WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+
+    with track_queries() as stats:
+        for ids in ([1], [1, 2], [1, 2, 3]):
+            connection.execute(lookup, {"ids": ids})
+        connection.execute(text("SELECT count(*) FROM item"))
+
+    assert stats.count == 4
+    assert stats.duration > 0
+    assert stats.repeated() == {"SELECT id FROM item WHERE id IN (?)": 3}
+    assert "max_repeat=3" in stats.header()
+
+
+def test_nested_trackers_both_count(connection):
+    with track_queries() as outer:
+        connection.execute(text("SELECT 1"))
+        with track_queries() as inner:
+            connection.execute(text("SELECT 2"))
+
+    connection.execute(text("SELECT 3"))
+    assert (outer.count, inner.count) == (2, 1)
+
+
+def test_query_budget(connection):
+    with query_budget(2):
+        connection.execute(text("SELECT 1"))
+        connection.execute(text("SELECT 2"))
+
+    with pytest.raises(QueryBudgetExceeded, match="The budget is 1 queries"):
+        with query_budget(1):
+            connection.execute(text("SELECT 1"))
+            connection.execute(text("SELECT 2"))
+
+
+def test_statement_shape_collapses_placeholder_lists():
+    assert statement_shape("SELECT *\n  FROM t WHERE id IN ($1, $2,$3) AND x = $4") == (
+        "SELECT * FROM t WHERE id IN (?) AND x = ?"
+    )
@@ -0,0 +1,30 @@
+from collections import namedtuple
+
+from fastapi.responses import JSONResponse
+
+from schemas import TweetFull, TweetGetResponse
+from services.serializers import feed_page_to_bytes, tweet_fragment, tweet_to_dict
+
+FeedRow = namedtuple("FeedRow", "id content user_id name like_count created_at")
+
+ROWS = [
+    FeedRow(3, 'Привет, "мир"!\n\tстрока \\ с \x01 управляющими 😀', 1, "Дарья", 2, None),
+    FeedRow(2, "plain ascii </script> & <b>", 2, "David", 0, None),
+    FeedRow(1, "", 3, "Patric", 0, None),
+]
+LIKES = {3: [{"user_id": 2, "name": "David"}, {"user_id": 3, "name": "Patric ✓"}]}
+PATHS = {3: ["/media/a.png", "/media/b_thumb.webp"], 2: ["/media/é.png"]}
+
+
+def generic_response_body(rows, next_cursor):
+    tweets = [TweetFull(**tweet_to_dict(row, LIKES.get(row.id, []), PATHS.get(row.id, []))) for row in rows]
+    return JSONResponse(TweetGetResponse(result=True, tweets=tweets, next_cursor=next_cursor).model_dump()).body
+
+
+def test_feed_page_bytes_match_generic_response():
+    fragments = [tweet_fragment(row, LIKES.get(row.id, []), PATHS.get(row.id, [])) for row in ROWS]
+    assert feed_page_to_bytes(fragments, "eyJ0IjoiMjAyNiJ9") == generic_response_body(ROWS, "eyJ0IjoiMjAyNiJ9")
+
+
+def test_empty_feed_page_bytes_match_generic_response():
+    assert feed_page_to_bytes([], None) == generic_response_body([], None)